@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of bureaucrate, see bench.py
+"""
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Times bureaucrate on a synthetic corpus, and writes the results as JSON so
+that they can be compared between versions:
+
+    python -m benchmarks.bench --messages 5000 --output new.json
+    python -m benchmarks.bench --compare old.json --output new.json
+"""
+import json
+import platform
+import shutil
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+from bureaucrate import __version__
+from bureaucrate.bureaucrate import ACTIONS, Message, init
+from bureaucrate.plan import Plan
+from bureaucrate.rules import RuleSet
+from bureaucrate.utils import Config
+
+from .corpus import generate, write_rules
+
+ACCOUNT = 'bench'
+MAILBOXES = ('INBOX', 'Lists')
+#: arguments of the actions timed. Each one runs on a fresh copy of the
+#: messages of the INBOX
+ACTION_ARGS = {
+    'mark_as_read': (),
+    'star': (),
+    'copy': ('Copies',),
+    'move_to': ('Moved',),
+    'archive': (),
+    'delete': (),
+    'forward': ('true', 'you@example.com'),
+}
+
+
+def measure(run: Callable, setup: Callable = lambda: None, repeat=3,
+            memory=True) -> dict:
+    """
+    Times run(setup()) 'repeat' times, setup excluded, and then measures the
+    peak of the memory allocated by one more run. 'run' returns the number
+    of items it handled.
+    """
+    runs = []
+    items = 0
+    for _ in range(repeat):
+        arg = setup()
+        start = perf_counter()
+        items = run(arg)
+        runs.append(perf_counter() - start)
+    best = min(runs)
+    result = {'seconds': best, 'runs': runs, 'items': items,
+              'us_per_item': best / items * 1e6 if items else None}
+    if memory:
+        arg = setup()
+        tracemalloc.start()
+        run(arg)
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def messages(boxes: dict, headers=True) -> List[Message]:
+    return [m for box in boxes.values() for m in box.messages(headers)]
+
+
+def suite(account: str, conf: Config, work: str, phases=None, repeat=3,
+          memory=True, forward_messages=20) -> Dict[str, dict]:
+    """
+    Runs the benchmarks named in 'phases', or all of them, on the maildirs
+    of 'account'. Actions are run on copies made in 'work'.
+    """
+    rules = {mb: conf.get('rules', [], mb, ACCOUNT) for mb in MAILBOXES}
+    rulesets = {mb: RuleSet(r) for mb, r in rules.items()}
+
+    def boxes():
+        return init(account, list(MAILBOXES))
+
+    def exec_rules(todo):
+        for m in todo:
+            m.exec_rules(rules[m.mailbox.name])
+        return len(todo)
+
+    def apply(todo, planned=False):
+        plan = Plan()
+        for m in todo:
+            ruleset = rulesets[m.mailbox.name]
+            if planned:
+                ruleset.plan(m, plan)
+            else:
+                ruleset.apply(m)
+        return len(todo)
+
+    benchmarks = {
+        'init': (lambda _: len(boxes()), None),
+        'iterate_headers': (lambda b: len(messages(b)), boxes),
+        'iterate_projection': (
+            lambda b: sum(1 for mb, box in b.items()
+                          for _ in box.messages(rulesets[mb].headers)),
+            boxes),
+        'iterate_stubs': (lambda b: len(messages(b, False)), boxes),
+        'load': (lambda todo: sum(1 for m in todo if m.load()),
+                 lambda: messages(boxes())),
+        'exec_rules': (exec_rules, lambda: messages(boxes())),
+        'ruleset_apply': (apply, lambda: messages(boxes())),
+        'ruleset_plan': (lambda todo: apply(todo, True),
+                         lambda: messages(boxes())),
+    }
+    copy = join(work, ACCOUNT)
+
+    def inbox_copy(limit=None):
+        shutil.rmtree(copy, ignore_errors=True)
+        shutil.copytree(account, copy)
+        return list(init(copy, ['INBOX'])['INBOX'])[:limit]
+
+    def act(name, args):
+        def run(todo):
+            for m in todo:
+                ACTIONS[name](m, *args)
+            return len(todo)
+        return run
+
+    for name, args in ACTION_ARGS.items():
+        limit = forward_messages if name == 'forward' else None
+        benchmarks['action_' + name] = (act(name, args),
+                                        lambda limit=limit: inbox_copy(limit))
+
+    results = {}
+    for name, (run, setup) in benchmarks.items():
+        if phases and name not in phases:
+            continue
+        results[name] = measure(run, setup or (lambda: None), repeat, memory)
+        print('%-20s %10.4fs %10s items %12s' % (
+            name, results[name]['seconds'], results[name]['items'],
+            '%d KiB' % (results[name]['peak_bytes'] // 1024)
+            if memory else ''), file=sys.stderr)
+    return results
+
+
+def compare(old: dict, new: dict, threshold=1.1) -> List[str]:
+    """
+    Describes how the timings of 'new' compare to those of 'old'
+
+    >>> compare({'results': {'init': {'seconds': 1.0}}},
+    ...         {'results': {'init': {'seconds': 1.5}}})
+    ['init                    1.50x  slower']
+    """
+    lines = []
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if not before or not before['seconds']:
+            continue
+        ratio = result['seconds'] / before['seconds']
+        verdict = ('slower' if ratio > threshold else
+                   'faster' if ratio < 1 / threshold else '')
+        lines.append(('%-20s %7.2fx  %s' % (name, ratio, verdict)).rstrip())
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(description='benchmarks bureaucrate on a '
+                                        'synthetic corpus')
+    parser.add_argument('--messages', type=int, default=1000,
+                        help='number of messages per mailbox')
+    parser.add_argument('--body-size', type=int, default=2048)
+    parser.add_argument('--attachments', type=float, default=0.1,
+                        help='share of messages with an attachment')
+    parser.add_argument('--attachment-size', type=int, default=65536)
+    parser.add_argument('--broken-charsets', type=float, default=0.05,
+                        help='share of messages with an undeclared charset')
+    parser.add_argument('--missing-dates', type=float, default=0.05,
+                        help='share of messages without a Date header')
+    parser.add_argument('--rules', type=int, default=50,
+                        help='number of rules per mailbox')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--forward-messages', type=int, default=20,
+                        help='number of messages forwarded')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure peak memory')
+    parser.add_argument('--only', action='append',
+                        help='run this benchmark only, can be repeated')
+    parser.add_argument('--corpus',
+                        help='directory where the corpus is generated, and '
+                             'kept. Reused if it exists')
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    args = parser.parse_args(argv)
+
+    params = {k: v for k, v in vars(args).items()
+              if k not in ('only', 'corpus', 'output', 'compare')}
+    with TemporaryDirectory() as tmp:
+        root = args.corpus or join(tmp, 'corpus')
+        account = join(root, ACCOUNT)
+        config = join(root, 'rules.cfg')
+        try:
+            with open(join(root, 'corpus.json')) as f:
+                corpus = json.load(f)
+        except FileNotFoundError:
+            corpus = generate(account, args.messages, MAILBOXES,
+                              args.body_size, args.attachments,
+                              args.attachment_size, args.broken_charsets,
+                              args.missing_dates, args.seed)
+            write_rules(config, root, ACCOUNT, MAILBOXES, args.rules,
+                        args.seed)
+            with open(join(root, 'corpus.json'), 'w') as f:
+                json.dump(corpus, f)
+        conf = Config()
+        conf.parse(config)
+        work = join(tmp, 'work')
+        results = suite(account, conf, work, args.only, args.repeat,
+                        not args.no_memory, args.forward_messages)
+
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now().isoformat(),
+        'params': params,
+        'corpus': corpus,
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), report)), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic maildirs, and rule files matching them, to benchmark
+bureaucrate on.
+"""
+import os
+from base64 import encodebytes
+from email.utils import formatdate
+from os.path import join
+from random import Random
+from time import time
+from typing import Dict, Iterable, Optional
+
+WORDS = ('report', 'meeting', 'invoice', 'release', 'build', 'failure',
+         'review', 'weekly', 'digest', 'update', 'security', 'notice',
+         'ticket', 'order', 'shipping', 'password', 'welcome', 'newsletter')
+#: subjects in a charset a mail client forgot to declare, read as
+#: unknown-8bit
+BROKEN_SUBJECTS = ('Réunion de début de mois'.encode('iso-8859-15'),
+                   'Überweisung fällig'.encode('cp1252'),
+                   '会議の議事録'.encode('shift_jis'))
+ENCODED_SUBJECTS = (b'=?utf-8?q?Caf=C3=A9_cr=C3=A8me?=',
+                    b'=?iso-8859-1?b?UulzdW3p?=')
+FLAGS = ('', 'S', 'S', 'RS', 'FS', 'F')
+
+
+def senders(count: int) -> list:
+    return ['user%d@example.com' % i for i in range(count)]
+
+
+def lists(count: int) -> list:
+    return ['list%d.example.org' % i for i in range(count)]
+
+
+def make_message(rng: Random, number: int, date: float, sender: str,
+                 list_id: Optional[str] = None, body_size=2048,
+                 attachment_size=0, broken_charset=False,
+                 missing_date=False) -> bytes:
+    """
+    Returns a message from 'sender', to list 'list_id' if set, with a body
+    of about 'body_size' bytes and, if 'attachment_size' is set, a binary
+    attachment that big.
+    """
+    headers = [
+        b'Return-Path: <bounces@example.net>',
+        b'Received: from mx.example.net (mx.example.net [192.0.2.1])\n'
+        b'\tby mail.example.com with ESMTPS id %d' % number,
+        b'Message-ID: <%d.%d@example.net>' % (number, rng.getrandbits(32)),
+        b'From: User <%s>' % sender.encode(),
+        b'To: me@example.com',
+    ]
+    if broken_charset:
+        subject = rng.choice(BROKEN_SUBJECTS)
+    elif rng.random() < 0.1:
+        subject = rng.choice(ENCODED_SUBJECTS)
+    else:
+        subject = ' '.join(rng.choice(WORDS) for _ in range(5)).encode()
+        if rng.random() < 0.2:
+            subject = b'[ticket #%d] ' % number + subject
+    headers.append(b'Subject: ' + subject)
+    if not missing_date:
+        headers.append(b'Date: ' + formatdate(date).encode())
+    if list_id is not None:
+        headers.append(b'List-Id: Some list <%s>' % list_id.encode())
+    if rng.random() < 0.05:
+        headers.append(b'X-Spam: yes')
+    headers.append(b'MIME-Version: 1.0')
+    line = b' '.join(rng.choice(WORDS).encode() for _ in range(10)) + b'\n'
+    body = line * max(1, body_size // len(line))
+    if not attachment_size:
+        headers.append(b'Content-Type: text/plain; charset=utf-8')
+        return b'\n'.join(headers) + b'\n\n' + body
+    headers.append(b'Content-Type: multipart/mixed; boundary="BOUNDARY"')
+    data = encodebytes(rng.getrandbits(attachment_size * 8).to_bytes(
+        attachment_size, 'little'))
+    return b'\n'.join(headers) + b'\n\n' + b'\n'.join((
+        b'--BOUNDARY', b'Content-Type: text/plain; charset=utf-8', b'', body,
+        b'--BOUNDARY', b'Content-Type: application/octet-stream',
+        b'Content-Disposition: attachment; filename="data.bin"',
+        b'Content-Transfer-Encoding: base64', b'', data,
+        b'--BOUNDARY--', b''))
+
+
+def generate(path: str, messages=1000, mailboxes: Iterable[str] = ('INBOX',),
+             body_size=2048, attachments=0.1, attachment_size=65536,
+             broken_charsets=0.05, missing_dates=0.05, seed=0,
+             sender_count=200, list_count=20) -> Dict[str, int]:
+    """
+    Writes 'messages' messages in each of 'mailboxes', maildirs created in
+    'path'. 'attachments', 'broken_charsets' and 'missing_dates' are the
+    shares of messages having an attachment, a subject in an undeclared
+    charset and no Date header. Messages are spread over the last two years,
+    which their file mtime and delivery time agree with. Returns the number
+    of messages of each kind written.
+    """
+    rng = Random(seed)
+    now = time()
+    addresses, list_ids = senders(sender_count), lists(list_count)
+    stats = {'messages': 0, 'attachments': 0, 'broken_charsets': 0,
+             'missing_dates': 0, 'bytes': 0}
+    number = 0
+    for mailbox in mailboxes:
+        for subdir in ('new', 'cur', 'tmp'):
+            os.makedirs(join(path, mailbox, subdir), exist_ok=True)
+        for _ in range(messages):
+            number += 1
+            date = int(now - rng.random() * 2 * 365 * 86400)
+            attachment = rng.random() < attachments
+            broken = rng.random() < broken_charsets
+            missing = rng.random() < missing_dates
+            data = make_message(
+                rng, number, date, rng.choice(addresses),
+                rng.choice(list_ids) if rng.random() < 0.3 else None,
+                body_size, attachment_size if attachment else 0, broken,
+                missing)
+            flags = rng.choice(FLAGS)
+            name = '%d.M%dP%d.bench' % (date, number, os.getpid())
+            if flags or rng.random() < 0.5:
+                file_path = join(path, mailbox, 'cur', name + ':2,' + flags)
+            else:
+                file_path = join(path, mailbox, 'new', name)
+            with open(file_path, 'wb') as f:
+                f.write(data)
+            os.utime(file_path, (date, date))
+            stats['messages'] += 1
+            stats['attachments'] += attachment
+            stats['broken_charsets'] += broken
+            stats['missing_dates'] += missing
+            stats['bytes'] += len(data)
+    return stats
+
+
+def write_rules(path: str, base_path: str, account: str,
+                mailboxes: Iterable[str] = ('INBOX',), rules=50, seed=0,
+                sender_count=200, list_count=20,
+                options: Optional[Dict[str, str]] = None, time_based=True):
+    """
+    Writes to 'path' a configuration file with 'rules' rules per mailbox,
+    mixing every kind of condition, and the global 'options'. Their actions
+    only change flags, so that running them leaves the corpus untouched on
+    disk. Without time_based, there are no older_than conditions, which
+    make incremental runs evaluate every message.
+    """
+    rng = Random(seed)
+    addresses, list_ids = senders(sender_count), lists(list_count)
+    kinds = [
+        lambda: "is_from '%s'" % rng.choice(addresses),
+        lambda: "subject_has '%s'" % rng.choice(WORDS),
+        lambda: "list_is '%s'" % rng.choice(list_ids),
+        lambda: "subject_matches '^.ticket #[0-9]+%d'" % rng.randrange(10),
+        lambda: 'is_spam',
+        lambda: 'is_list and starred and negate',
+    ]
+    if time_based:
+        kinds.insert(4, lambda: "older_than '%dM' and read" %
+                     rng.randrange(1, 24))
+    lines = ['base_path = %s' % base_path]
+    lines.extend('%s = %s' % option for option in sorted(
+        (options or {}).items()))
+    lines.append('%s {' % account)
+    for mailbox in mailboxes:
+        lines.append('    %s {' % mailbox)
+        for i in range(rules):
+            action = 'star' if i % 2 else 'mark_as_read'
+            lines.append('        if %s then %s' % (kinds[i % len(kinds)](),
+                                                    action))
+        lines.append('    }')
+    lines.append('}')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Times the start of the command line in fresh interpreters, and checks it
+against the budget of cron runs with nothing to do:
+
+    python -m benchmarks.startup --output startup.json
+"""
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser
+from os.path import dirname, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+from typing import Dict, List, Optional
+
+from bureaucrate.changes import STATE_FILE
+
+from .corpus import generate, write_rules
+
+#: seconds allowed on top of the start of the interpreter, for a run with
+#: nothing to do
+BUDGET = 0.05
+#: modules which runs with nothing to do must not import
+HEAVY_MODULES = ('bureaucrate.bureaucrate', 'chardet', 'dateutil',
+                 'email.policy', 'mailbox', 'smtplib', 'sqlite3',
+                 'subprocess', 'concurrent.futures.process')
+ACCOUNT = 'bench'
+
+
+def make_idle(root: str, messages=100) -> str:
+    """
+    Writes a corpus in 'root', processes it once and returns the path of its
+    configuration, so that the next runs have nothing to do. Its parsed
+    configuration is cached in 'root' as well.
+    """
+    generate(join(root, ACCOUNT), messages, attachments=0)
+    config = join(root, 'rules.cfg')
+    write_rules(config, root, ACCOUNT, rules=10,
+                options={'incremental': 'yes'}, time_based=False)
+    cli(config)
+    # recent mtimes are not trusted to tell that nothing changed
+    past = time() - 60
+    for directory, _, _ in os.walk(join(root, ACCOUNT)):
+        os.utime(directory, (past, past))
+    os.utime(config, (past, past))
+    cli(config)
+    if not os.path.exists(join(root, STATE_FILE)):
+        raise RuntimeError('the state of the corpus was not recorded')
+    return config
+
+
+def environment(config: str) -> Dict[str, str]:
+    return dict(os.environ, XDG_CACHE_HOME=join(dirname(config), '.cache'))
+
+
+def cli(config: str):
+    subprocess.run([sys.executable, '-m', 'bureaucrate', '-c', config],
+                   check=True, env=environment(config))
+
+
+def spawn(args: List[str], repeat: int, config: str) -> float:
+    """
+    Returns the best time of 'repeat' runs of the interpreter with 'args'
+    """
+    runs = []
+    for _ in range(repeat):
+        start = perf_counter()
+        subprocess.run([sys.executable] + args, check=True,
+                       env=environment(config))
+        runs.append(perf_counter() - start)
+    return min(runs)
+
+
+def imported(config: str) -> List[str]:
+    """
+    Returns the HEAVY_MODULES imported by a run of 'config'
+    """
+    code = ('import sys\n'
+            'sys.argv = ["bureaucrate", "-c", %r]\n'
+            'from bureaucrate.__main__ import main\n'
+            'main()\n'
+            'print(" ".join(m for m in %r if m in sys.modules))\n'
+            % (config, HEAVY_MODULES))
+    output = subprocess.run([sys.executable, '-c', code], check=True,
+                            stdout=subprocess.PIPE,
+                            env=environment(config)).stdout
+    return output.decode().split()
+
+
+def suite(config: str, repeat=10) -> Dict[str, float]:
+    interpreter = spawn(['-c', 'pass'], repeat, config)
+    return {
+        'interpreter': interpreter,
+        'import': spawn(['-c', 'import bureaucrate.__main__'], repeat,
+                        config) - interpreter,
+        'nothing_to_do': spawn(['-m', 'bureaucrate', '-c', config], repeat,
+                               config) - interpreter,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = ArgumentParser(description='times the start of bureaucrate')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help='seconds allowed for a run with nothing to do, '
+                             'on top of the start of the interpreter')
+    parser.add_argument('--output', help='JSON file to write results to')
+    args = parser.parse_args(argv)
+    with TemporaryDirectory() as tmp:
+        config = make_idle(tmp)
+        heavy = imported(config)
+        results = suite(config, args.repeat)
+    for name, seconds in results.items():
+        print('%-20s %8.1fms' % (name, seconds * 1000), file=sys.stderr)
+    report = {'results': results, 'budget': args.budget,
+              'heavy_imports': heavy}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if heavy:
+        print('imported with nothing to do: %s' % ', '.join(heavy),
+              file=sys.stderr)
+        return 1
+    if results['nothing_to_do'] > args.budget:
+        print('over the budget of %.1fms' % (args.budget * 1000),
+              file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
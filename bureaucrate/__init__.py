@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
-from .bureaucrate import init
-
 
 __author__ = """Paul Ollivier"""
 __email__ = 'contact@paulollivier.fr'
 __version__ = '0.3.8'
+
+
+def init(*args, **kwargs):
+    """
+    Same as bureaucrate.bureaucrate.init(), which is only imported when
+    called: importing the package, as the command line does, stays cheap
+    """
+    from .bureaucrate import init
+    return init(*args, **kwargs)
@@ -1,18 +1,54 @@
+import json
 import logging
 from argparse import ArgumentParser
 from os.path import expanduser, join
-from sys import argv
+from sys import argv, exit, stderr
+from typing import List
 
-from . import __version__
-from .bureaucrate import init, logger
-from .utils import Config
+from . import __version__, changes, stats
+from .metrics import write_textfile
+from .utils import Config, cache_path, parse_bool, time_based
 
+logger = logging.getLogger(__package__)
+FORMAT = "%(filename)s:%(lineno)3s - %(funcName)15s - %(levelname)s: %(" \
+         "message)s"
 
-def process_account(conf: Config, account: str):
-    acc = init(join(conf.get("base_path"), account))
-    for mailbox in conf.get_mailboxes(account):
-        for message in acc[mailbox]:
-            message.exec_rules(conf.get('rules', [], mailbox, account))
+
+def watched_paths(conf: Config, accounts: List[str],
+                  config: str) -> List[str]:
+    """
+    Returns the paths whose mtimes tell whether a run of 'accounts' would
+    have something to do: the directories of their mailboxes, and the
+    configuration file
+    """
+    paths = [config]
+    for account in accounts:
+        for mailbox in conf.get_mailboxes(account):
+            for subdir in ('new', 'cur'):
+                paths.append(join(expanduser(conf.get('base_path')), account,
+                                  mailbox, subdir))
+    return paths
+
+
+def may_skip(conf: Config, accounts: List[str], opts: dict) -> bool:
+    """
+    Returns True if a run of 'accounts' only evaluates the messages which
+    arrived since the last one, so that it has nothing to do when no
+    mailbox changed
+    """
+    if (opts.get('daemon') or opts.get('full') or opts.get('dry_run') or
+            opts.get('max_messages')):
+        return False
+    for account in accounts:
+        if not parse_bool(conf.get('incremental', account=account)):
+            return False
+        for mailbox in conf.get_mailboxes(account):
+            # messages left over by a capped run are not new anymore, and
+            # those seen before may have grown old enough for a rule
+            if (conf.get('max_messages', None, mailbox, account) is not None
+                    or time_based(conf.get('rules', [], mailbox, account))):
+                return False
+    return True
 
 
 def main():
@@ -21,25 +57,95 @@ def main():
     parser.add_argument('-a', '--account', help="Restrict to an account")
     parser.add_argument('-c', '--config', default='~/.bureaucraterc',
                         help='specify an alternate configuration file')
+    parser.add_argument('--no-config-cache', action='store_true',
+                        help='parse the configuration file again, instead '
+                             'of using the result cached in ~/.cache')
     parser.add_argument('--debug', dest='loglevel', help='enable debug logging',
                         action='store_const', const=logging.DEBUG,
                         default=logging.WARNING)
+    parser.add_argument('--full', action='store_true',
+                        help='evaluate every message, even in incremental '
+                             'mode')
+    parser.add_argument('--max-messages', type=int, metavar='N',
+                        help='process at most N messages per mailbox, the '
+                             'others being left for the next runs in '
+                             'incremental mode')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of accounts processed in parallel')
+    parser.add_argument('--plan', action='store_true',
+                        help='evaluate all rules first, then run the actions '
+                             'grouped by destination mailbox')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the actions that would be run')
+    parser.add_argument('-d', '--daemon', action='store_true',
+                        help='keep running, processing messages as they are '
+                             'delivered and rescanning mailboxes on their '
+                             'refresh interval')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time spent per mailbox, rule, '
+                             'condition and action at exit')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='with --profile, also write it to FILE as JSON')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write metrics of the run to FILE for the '
+                             'Prometheus textfile collector')
     opts = vars(parser.parse_args(argv[1:]))
-    conf = Config()
-    conf.parse(expanduser(opts.get('config')))
-
-    logger.setLevel(opts.get('loglevel'))
+    logging.basicConfig(format=FORMAT)
+    logging.getLogger(__package__).setLevel(opts.get('loglevel'))
 
     if opts.get('version', None):
         print("bureaucrate v{}".format(__version__))
         return
 
+    config = expanduser(opts.get('config'))
+    conf = Config()
+    conf.parse(config, None if opts.get('no_config_cache')
+               else cache_path(config))
+    if not opts.get('metrics') and conf.get('metrics'):
+        opts['metrics'] = expanduser(conf.get('metrics').strip('\'"'))
+    if opts.get('profile') or opts.get('metrics'):
+        stats.enable()
+
     if opts.get('account', None):
-        process_account(conf, opts.get('account'))
+        accounts = [opts.get('account')]
     else:
-        for account in conf.get_accounts():
-            process_account(conf, account)
+        accounts = conf.get_accounts()
+    state, mtimes = None, None
+    if may_skip(conf, accounts, opts):
+        state = join(expanduser(conf.get('base_path')), changes.STATE_FILE)
+        mtimes = changes.snapshot(watched_paths(conf, accounts, config))
+        if changes.unchanged(state, mtimes):
+            logger.info('no mailbox changed since the last run')
+            report(opts, True)
+            return 0
+    # the engine and its dependencies are only imported from here on
+    from .runner import run
+    code = 1
+    try:
+        code = run(conf, accounts, opts)
+        if code == 0 and state is not None:
+            changes.save(state, mtimes)
+        return code
+    finally:
+        report(opts, code == 0)
+
+
+def report(opts: dict, success: bool):
+    """
+    Outputs the statistics collected for --profile and --metrics
+    """
+    if opts.get('profile'):
+        print(stats.current.report(), file=stderr)
+        if opts.get('profile_output'):
+            with open(opts.get('profile_output'), 'w') as f:
+                json.dump(stats.current.as_dict(), f, indent=2)
+    if opts.get('metrics'):
+        try:
+            write_textfile(opts.get('metrics'), stats.current, success)
+        except OSError as e:
+            logger.error('cannot write metrics to %s: %s',
+                         opts.get('metrics'), e)
 
 
-if '__main__' in __name__:
-    main()
+if __name__ == '__main__':
+    exit(main())
@@ -1,37 +1,514 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from email import message_from_binary_file
 from email.header import decode_header
-from functools import wraps
-from logging import basicConfig, getLogger
+from email.utils import parseaddr, parsedate_to_datetime
+from functools import lru_cache, wraps
+from io import BytesIO
+from logging import DEBUG, getLogger
 from mailbox import Maildir, MaildirMessage, Message
-from os import listdir
-from os.path import expanduser, join
-from subprocess import PIPE, run
-from typing import Dict, List, Optional, Type
-
-from chardet import detect
-from dateutil.parser import parse as dateparse
+from os import link as os_link
+from os import listdir, rename, scandir, stat
+from os.path import (basename, expanduser, getmtime, isdir, join, normpath,
+                     split)
+from time import time
+from typing import Dict, FrozenSet, List, Optional, Type
 
+from .delivery import Forwarded, deliver
+from .index import Index
+from .stats import count, measured
 from .utils import parse_timespec
 
 logger = getLogger(__name__)
-FORMAT = "%(filename)s:%(lineno)3s - %(funcName)15s - %(levelname)s: %(" \
-         "message)s"
-basicConfig(format=FORMAT)
 
 
 class ConditionError(Exception):
     pass
 
 
+#: charsets tried in order on header bytes of unknown charset, before
+#: resorting to detection. See set_charsets()
+charsets = ['utf-8']
+#: maximum number of bytes looked at by charset detection
+DETECT_MAX_BYTES = 2048
+
+
+def set_charsets(names: List[str]):
+    """
+    Sets the charsets tried after UTF-8 on header bytes of unknown charset.
+    The first one decoding them wins: permissive charsets, such as
+    single-byte ones or shift_jis, which decodes most pairs of Latin-1
+    bytes, shadow those listed after them.
+    """
+    global charsets
+    charsets = ['utf-8'] + [n for n in names if n.lower() != 'utf-8']
+    guess_charset.cache_clear()
+
+
+@lru_cache(maxsize=4096)
+def guess_charset(raw: bytes) -> Optional[str]:
+    """
+    Returns the first of the configured charsets 'raw' can be decoded with,
+    or else the one detected by chardet. Results are cached, as the same
+    garbage tends to be found in many messages.
+
+    >>> guess_charset('café'.encode('utf-8'))
+    'utf-8'
+    >>> set_charsets(['iso-8859-15'])
+    >>> guess_charset('café'.encode('iso-8859-15'))
+    'iso-8859-15'
+    >>> set_charsets([])
+    """
+    for charset in charsets:
+        try:
+            raw.decode(charset)
+            return charset
+        except (UnicodeDecodeError, LookupError):
+            continue
+    # chardet takes a while to import, and is seldom needed
+    from chardet import detect
+    return detect(raw[:DETECT_MAX_BYTES])['encoding']
+
+
+def read_header_block(fp) -> bytes:
+    """
+    Reads the header block of the message in 'fp', up to and including the
+    empty line separating it from the body. The body itself is not read.
+
+    >>> from io import BytesIO
+    >>> read_header_block(BytesIO(b'Subject: hi\\n\\nbody\\n'))
+    b'Subject: hi\\n\\n'
+    """
+    lines = []
+    for line in fp:
+        lines.append(line)
+        if line in (b'\n', b'\r\n'):
+            break
+    return b''.join(lines)
+
+
+def fold_header(name: str, value: str) -> bytes:
+    """
+    Returns the header field 'name' set to 'value', encoded and folded as in
+    the files of maildirs
+
+    >>> fold_header('From', 'Renée <r@test.org>')
+    b'From: =?utf-8?q?Ren=C3=A9e?= <r@test.org>\\n'
+    """
+    from email.policy import SMTP
+    policy = SMTP.clone(linesep='\n')
+    return policy.fold_binary(*policy.header_store_parse(name, value))
+
+
+def project_headers(block: bytes, names: FrozenSet[str]) -> bytes:
+    """
+    Drops the fields of the header block 'block' whose lowercase name is not
+    in 'names'. Folded fields are kept or dropped whole.
+
+    >>> project_headers(b'From: me\\nSubject: a\\n  b\\nTo: you\\n\\n',
+    ...                 frozenset(['subject']))
+    b'Subject: a\\n  b\\n\\n'
+    """
+    kept = []
+    keep = False
+    for line in block.splitlines(keepends=True):
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                kept.append(line)
+            continue
+        if line in (b'\n', b'\r\n'):
+            kept.append(line)
+            break
+        name = line.split(b':', 1)[0].strip().lower()
+        keep = name.decode('ascii', 'replace') in names
+        if keep:
+            kept.append(line)
+    return b''.join(kept)
+
+
+@measured('parse', 'message')
+def parse_message(fp):
+    """
+    Parses the whole message in binary file 'fp'
+    """
+    return message_from_binary_file(fp)
+
+
+def parse_date(value: Optional[str]) -> Optional[float]:
+    """
+    Returns the timestamp of the Date header 'value', or None if it cannot be
+    parsed. RFC 2822 dates are parsed by the standard library, dateutil is
+    only tried on the others.
+
+    >>> parse_date('Mon, 20 Aug 2018 10:00:00 +0200')
+    1534752000.0
+    >>> parse_date('2018-08-20T10:00:00+02:00')
+    1534752000.0
+    >>> parse_date('sometime')
+    """
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        pass
+    # dateutil takes a while to import, and is seldom needed
+    from dateutil.parser import parse as dateparse
+    try:
+        return dateparse(value).timestamp()
+    except (ValueError, OverflowError):
+        return None
+
+
+def delivery_time(key: str) -> Optional[float]:
+    """
+    Returns the delivery time recorded at the start of the maildir unique
+    name 'key', or None if it does not start with one.
+
+    >>> delivery_time('1534752000.M5P42Q1.host')
+    1534752000.0
+    >>> delivery_time('custom-name')
+    """
+    digits = key.split('.', 1)[0]
+    return float(digits) if digits.isdigit() else None
+
+
+#: where the date of a message, as used by older_than and archive, comes from:
+#: the mtime of its file, the delivery time in its file name, or its Date
+#: header. The last two fall back to the previous ones.
+DATE_SOURCES = ('mtime', 'delivery', 'header')
+
+
 class Mailbox(Maildir):
+    def __init__(self, dirname, factory=None, create=True,
+                 index: Optional[Index] = None, date_source='mtime'):
+        super().__init__(dirname, factory, create)
+        self.name = basename(normpath(dirname))
+        #: account/mailbox, as found in statistics
+        self.label = '%s/%s' % (basename(split(normpath(dirname))[0]),
+                                self.name)
+        self.index = index
+        #: number of messages read ahead by a thread pool while iterating
+        self.prefetch = 0
+        #: one of DATE_SOURCES
+        self.date_source = date_source
+        #: maximum number of messages yielded by messages(), if any. The
+        #: others are left for the next runs in incremental mode
+        self.max_messages = None  # type: Optional[int]
+        #: whether messages() yields every message even in incremental mode,
+        #: as rules depending on the age of messages need
+        self.full = False
+        #: keys of the last listing, by inode
+        self._order = []  # type: List[str]
+
+    def _refresh(self):
+        """
+        Lists the messages of the mailbox, unless neither new/ nor cur/ were
+        modified since the last listing, as Maildir does. Entries are read
+        with scandir, which tells files from directories without a stat()
+        per message, and their keys are ordered by inode: files are mostly
+        laid out on disk in that order.
+        """
+        # mtimes have a resolution of a second or two: listings of the last
+        # seconds are not trusted
+        if time() - self._last_read > 2 + self._skewfactor:
+            changed = False
+            for subdir in self._toc_mtimes:
+                mtime = getmtime(self._paths[subdir])
+                changed = changed or mtime > self._toc_mtimes[subdir]
+                self._toc_mtimes[subdir] = mtime
+            if not changed:
+                return
+        entries = []
+        for subdir in self._toc_mtimes:
+            for entry in scandir(self._paths[subdir]):
+                if not entry.is_dir():
+                    entries.append((entry.inode(),
+                                    entry.name.split(self.colon)[0],
+                                    join(subdir, entry.name)))
+        entries.sort()
+        self._toc = {key: subpath for _, key, subpath in entries}
+        self._order = [key for _, key, _ in entries]
+        self._last_read = time()
+
     def __iter__(self):
-        for k, v in self.iteritems():
-            v.mailbox = self
-            v.key = k
-            yield v
+        """
+        Yields lazily loaded messages: only their headers are read, the body
+        is loaded when an action needs it.
+        """
+        return self.messages()
+
+    def messages(self, headers=True):
+        """
+        Yields the messages of the mailbox, in inode order. 'headers' is
+        either True to read every header, or the lowercase names of the only
+        headers to read. Without any, messages are built from their file name
+        alone, which holds their flags, and no file is opened. See
+        Message.load()
+        """
+        headers = self._with_date(headers)
+        self._refresh()
+        # keys renamed out of the mailbox since the listing are left out
+        keys = todo = [key for key in self._order if key in self._toc]
+        names = None
+        if self.index is not None and self.index.incremental:
+            names = [basename(self._toc[key]) for key in keys]
+            if self.full and not self.index.full:
+                logger.info('%s: evaluating every message, as rules depend '
+                            'on their age', self.name)
+            elif not self.index.full:
+                seen = self.index.get_seen(self.name)
+                todo = [key for key, name in zip(keys, names)
+                        if name not in seen]
+                logger.info('%s: %d new messages out of %d', self.name,
+                            len(todo), len(keys))
+                count('skipped', self.label, len(keys) - len(todo))
+        if self.max_messages is not None and len(todo) > self.max_messages:
+            later = set(todo[self.max_messages:])
+            todo = todo[:self.max_messages]
+            logger.info('%s: %d messages left for the next runs', self.name,
+                        len(later))
+            if names is not None:
+                # not seen yet, so that they are processed next time
+                names = [name for key, name in zip(keys, names)
+                         if key not in later]
+        count('scanned', self.label, len(todo))
+        projection = None if headers is True else frozenset(headers or ())
+        if not headers:
+            for key in todo:
+                yield self.get_stub(key)
+        elif self.prefetch > 0:
+            yield from self._prefetched(todo, projection)
+        else:
+            for key in todo:
+                try:
+                    yield self.get_headers(key, projection)
+                except (KeyError, FileNotFoundError):
+                    logger.debug('message %s vanished from %s', key,
+                                 self._path)
+        if self.index is not None:
+            if self.index.cache_headers and projection:
+                self.index.prune(self.name, keys)
+            if names is not None and self.index.record:
+                self.index.set_seen(self.name, names)
+            self.index.commit()
+
+    def _prefetched(self, keys: List[str],
+                    projection: Optional[FrozenSet[str]]):
+        """
+        Yields the messages 'keys' in order, while the next ones are read by
+        a pool of self.prefetch threads. At most self.prefetch messages are
+        held in advance.
+        """
+        window = deque()
+        pending = iter(keys)
+        with ThreadPoolExecutor(self.prefetch) as pool:
+            try:
+                for key in pending:
+                    subpath = self._toc[key]
+                    window.append(pool.submit(self._load, key, subpath,
+                                              projection))
+                    if len(window) < self.prefetch:
+                        continue
+                    msg = self._next_prefetched(window)
+                    if msg is not None:
+                        yield msg
+                while window:
+                    msg = self._next_prefetched(window)
+                    if msg is not None:
+                        yield msg
+            finally:
+                for future in window:
+                    future.cancel()
+
+    def _next_prefetched(self, window: deque) -> Optional['Message']:
+        try:
+            return window.popleft().result()
+        except FileNotFoundError as e:
+            logger.debug('message vanished from %s: %s', self._path, e)
+            return None
+
+    def adopt(self, msg: 'Message', link=False) -> str:
+        """
+        Renames the file of 'msg', or hard links it with 'link', into this
+        mailbox. Its unique name is kept, and its subdir and flags are the
+        ones set on 'msg'. Returns its key.
+
+        Raises OSError when the file cannot be renamed or linked, as when the
+        mailboxes are on different filesystems, or when the mailbox already
+        holds a file of that unique name, as a copy of the message does.
+        """
+        source = msg.mailbox
+        if not self._last_read:
+            # never listed: files put there by earlier runs are not known yet.
+            # Later adoptions and additions keep the listing up to date
+            self._refresh()
+        if source is not self and msg.key in self._toc:
+            raise FileExistsError(errno.EEXIST, 'key already in mailbox',
+                                  msg.key)
+        info = msg.get_info()
+        subpath = join(msg.get_subdir(),
+                       msg.key + (self.colon + info if info else ''))
+        if link:
+            os_link(source.get_path(msg.key), join(self._path, subpath))
+        else:
+            rename(source.get_path(msg.key), join(self._path, subpath))
+            source._toc.pop(msg.key, None)
+        self._toc[msg.key] = subpath
+        return msg.key
+
+    def get_entry(self, subpath: str, headers=True) -> 'Message':
+        """
+        Returns the message stored at 'subpath', as reported by a filesystem
+        notification, without listing the mailbox. 'headers' is as in
+        Mailbox.messages()
+        """
+        key = basename(subpath).split(self.colon)[0]
+        self._toc[key] = subpath
+        headers = self._with_date(headers)
+        if not headers:
+            return self.get_stub(key)
+        return self._load(key, subpath,
+                          None if headers is True else frozenset(headers))
+
+    def record_seen(self, subpaths: List[str]):
+        """
+        Adds the messages stored at 'subpaths', processed without listing
+        the mailbox as from get_entry(), to the watermark of incremental
+        mode, as messages() does, and commits the index
+        """
+        if self.index is None:
+            return
+        if self.index.incremental and self.index.record:
+            self.index.add_seen(self.name, [basename(p) for p in subpaths])
+        self.index.commit()
+
+    def _with_date(self, headers):
+        # dates taken from the Date header need it read
+        if self.date_source == 'header' and headers is not True:
+            return frozenset(headers or ()) | {'date'}
+        return headers
+
+    def get_path(self, key: str) -> str:
+        return join(self._path, self._lookup(key))
+
+    def date_of(self, key: str, path: str,
+                header_date: Optional[float] = None) -> float:
+        """
+        Returns the date of the message 'key' stored at 'path', according to
+        date_source. 'header_date' is its parsed Date header, if read.
+        """
+        if self.date_source == 'header' and header_date is not None:
+            return header_date
+        if self.date_source != 'mtime':
+            delivered = delivery_time(key)
+            if delivered is not None:
+                return delivered
+        return getmtime(path)
+
+    def get_stub(self, key: str) -> 'Message':
+        """
+        Returns the message 'key' with only its subdir and flags set, as
+        found in its file name.
+        """
+        msg = Message()
+        subpath = self._toc[key]
+        self._describe(msg, key, subpath)
+        msg.set_date(self.date_of(key, join(self._path, subpath)))
+        msg.headers_loaded = False
+        return msg
+
+    def get_headers(self, key: str,
+                    projection: Optional[FrozenSet[str]] = None) -> 'Message':
+        """
+        Returns the message 'key' with only its header block parsed. If
+        'projection' is given, only the headers it names are kept, and the
+        message is built from the index when it covers them and the message
+        has not changed since it was indexed. See Message.load()
+        """
+        return self._load(key, self._lookup(key), projection)
+
+    def _load(self, key: str, subpath: str,
+              projection: Optional[FrozenSet[str]]) -> 'Message':
+        # called from prefetch threads as well: must not refresh the toc
+        path = join(self._path, subpath)
+        if (self.index is None or not self.index.cache_headers or
+                projection is None or
+                not projection <= Index.INDEXED_HEADERS):
+            count('parsed', self.label)
+            msg = self._read_headers(path, projection)
+            msg.set_date(self.date_of(key, path, parse_date(msg['date'])
+                                      if self.date_source == 'header'
+                                      else None))
+            self._describe(msg, key, subpath)
+            return msg
+        name = basename(subpath)
+        info = name.split(self.colon)[-1] if self.colon in name else ''
+        st = stat(path)
+        entry = self.index.get(self.name, key, st)
+        if entry is None:
+            count('parsed', self.label)
+            msg = self._read_headers(path, Index.INDEXED_HEADERS)
+            # decoding errors are counted against this mailbox
+            msg.mailbox = self
+            date = parse_date(self._decoded_or_none(msg, key, 'date'))
+            headers = {}
+            for header, _ in Index.HEADERS:
+                value = self._decoded_or_none(msg, key, header)
+                if value is not None:
+                    headers[header] = value
+            self.index.put(self.name, key, st, info, date, headers)
+        else:
+            indexed_info, date, headers = entry
+            msg = Message()
+            for header, value in headers.items():
+                msg[header] = value
+            if indexed_info != info:
+                self.index.set_info(self.name, key, info)
+        msg.set_date(self.date_of(key, path, date))
+        self._describe(msg, key, subpath)
+        return msg
+
+    def _decoded_or_none(self, msg: 'Message', key: str,
+                         header: str) -> Optional[str]:
+        """
+        Returns the decoded 'header' of message 'key', or None if it is
+        missing or cannot be decoded: headers no rule reads are indexed all
+        the same, and must not fail the mailbox.
+        """
+        if header not in msg:
+            return None
+        try:
+            return msg[header]
+        except (ValueError, LookupError) as e:
+            logger.warning('cannot decode %s of %s in %s, indexed as '
+                           'missing: %s', header, key, self.name, e)
+            return None
+
+    def _describe(self, msg: 'Message', key: str, subpath: str):
+        subdir, name = split(subpath)
+        msg.set_subdir(subdir)
+        if self.colon in name:
+            msg.set_info(name.split(self.colon)[-1])
+        msg.mailbox = self
+        msg.key = key
+        msg.loaded = False
+
+    @staticmethod
+    @measured('parse', 'headers')
+    def _read_headers(path: str,
+                      projection: Optional[FrozenSet[str]] = None
+                      ) -> 'Message':
+        with open(path, 'rb') as f:
+            block = read_header_block(f)
+        if projection is not None:
+            block = project_headers(block, projection)
+        return Message(block)
 
 
 class Account(object):
@@ -44,6 +521,8 @@ class Account(object):
 
 base_path: Type[str]
 mailboxes = Dict[str, Mailbox]
+index = None  # type: Optional[Index]
+mailbox_date_source = 'mtime'
 
 
 def get_mailbox(mb_id: str) -> Mailbox:
@@ -56,33 +535,123 @@ def get_mailbox(mb_id: str) -> Mailbox:
     global mailboxes
     if mb_id not in mailboxes:
         # noinspection PyTypeChecker
-        mb = Mailbox(join(base_path, mb_id), factory=Message.message_factory)
+        mb = Mailbox(join(base_path, mb_id), factory=Message.message_factory,
+                     index=index, date_source=mailbox_date_source)
         mailboxes[mb_id] = mb
     else:
         mb = mailboxes[mb_id]
     return mb
 
 
-def init(mailbox_base: str, mailbox_names=None) -> Dict[str, Mailbox]:
+def activate(mailbox_base: str, boxes: Dict[str, Mailbox]):
+    """
+    Makes the mailboxes returned by an earlier call to init() the current
+    ones again, as used by get_mailbox()
+    """
+    global mailboxes, base_path, index, mailbox_date_source
+    base_path = expanduser(mailbox_base)
+    mailboxes = boxes
+    if boxes:
+        box = next(iter(boxes.values()))
+        index, mailbox_date_source = box.index, box.date_source
+    else:
+        index = None
+
+
+def init(mailbox_base: str, mailbox_names=None, use_index=False,
+         incremental=False, full=False, dry_run=False,
+         date_source='mtime') -> Dict[str, Mailbox]:
+    """
+    Opens the mailboxes found in mailbox_base. With use_index, message
+    metadata is cached in an Index stored in mailbox_base. With incremental,
+    iterating a mailbox only yields the messages not seen on the last run,
+    unless full is set. With dry_run, messages are not marked as seen.
+    date_source is one of DATE_SOURCES.
+    """
     if mailbox_names is None:
         mailbox_names = []
+    if date_source not in DATE_SOURCES:
+        raise ValueError('unknown date source: %s' % date_source)
     logger.info('Initializing mailboxes at %s', mailbox_base)
-    global mailboxes, base_path
+    global mailboxes, base_path, index, mailbox_date_source
+    mailbox_date_source = date_source
     base_path = expanduser(mailbox_base)
     if not mailbox_names:
-        mailbox_names = [e for e in listdir(base_path)]
+        mailbox_names = [e for e in listdir(base_path)
+                         if isdir(join(base_path, e))]
+    index = None
+    if use_index or incremental:
+        index = Index(join(base_path, Index.FILENAME), cache_headers=use_index,
+                      incremental=incremental, full=full,
+                      record=not dry_run)
     mailboxes = {}
     for mailbox_name in mailbox_names:
         mailboxes[mailbox_name] = Mailbox(join(mailbox_base, mailbox_name),
-                                          factory=Message.message_factory)
+                                          factory=Message.message_factory,
+                                          index=index,
+                                          date_source=mailbox_date_source)
         logger.debug('mailbox found in %s: %s', mailbox_base, mailbox_name)
     return mailboxes
 
 
+#: lowercase names of the headers read by each condition. Conditions which
+#: read none are answered from the flags in the file name of a message.
+CONDITION_HEADERS = {
+    'negate': (),
+    'starred': (),
+    'read': (),
+    'has_replied': (),
+    'older_than': (),
+    'is_from': ('from',),
+    'subject_has': ('subject',),
+    'is_list': ('list-id',),
+    'list_is': ('list-id',),
+    'is_spam': ('x-spam',),
+    'subject_matches': ('subject',),
+    'from_matches': ('from',),
+}
+
+
+def headers_needed(rules: List) -> Optional[FrozenSet[str]]:
+    """
+    Returns the lowercase names of the headers read by the conditions of
+    'rules', or None if a condition may read any header. When empty,
+    messages do not need to be opened to evaluate the rules.
+
+    >>> headers_needed([{'conditions': [['read'], ['starred']],
+    ...                  'actions': [['archive']]}])
+    frozenset()
+    >>> headers_needed([{'conditions': [['read'], ['is_from', 'me']],
+    ...                  'actions': [['archive']]}])
+    frozenset({'from'})
+    >>> headers_needed([{'conditions': [['header_matches', 'X-Mailer', 'a']],
+    ...                  'actions': [['archive']]}])
+    frozenset({'x-mailer'})
+    """
+    headers = set()
+    for rule in rules:
+        for cond in rule['conditions']:
+            if not cond:
+                continue
+            if cond[0] == 'header_matches' and len(cond) > 1:
+                headers.add(cond[1].lower())
+                continue
+            if cond[0] not in CONDITION_HEADERS:
+                return None
+            headers.update(CONDITION_HEADERS[cond[0]])
+    return frozenset(headers)
+
+
+#: conditions and actions usable in rules, by name
+CONDITIONS = {}
+ACTIONS = {}
+
+
 def condition(f):
     """
     Decorator for conditions
     """
+    CONDITIONS[f.__name__] = f
 
     @wraps(f)
     def try_execute(*args, **kwargs):
@@ -101,6 +670,7 @@ def action(f):
     decorator for actions. Reinitialises the conditions_result array after
     action execution
     """
+    ACTIONS[f.__name__] = f
 
     @wraps(f)
     def decorate(message, *args, **kwargs):
@@ -118,7 +688,29 @@ class Message(MaildirMessage):
     """
 
     def __getitem__(self, name):
-        """Let's convert headers to str"""
+        """
+        Let's convert headers to str. Decoded values are kept until headers
+        are modified.
+
+        >>> m = Message()
+        >>> m['Subject'] = '=?utf-8?q?caf=C3=A9?='
+        >>> m['subject']
+        'café'
+        >>> m.replace_header('Subject', 'tea')
+        >>> m['subject']
+        'tea'
+        """
+        key = name.lower()
+        if key not in self._decoded:
+            try:
+                self._decoded[key] = self._decode(name)
+            except (ValueError, LookupError):
+                count('errors', getattr(self.mailbox, 'label', ''))
+                raise
+        return self._decoded[key]
+
+    @measured('decode', 'header')
+    def _decode(self, name):
         message = []
         if name not in self:
             logger.debug("name not found: %s", name)
@@ -128,11 +720,12 @@ class Message(MaildirMessage):
             if type(t[0]) is bytes:
                 if t[1] == 'unknown-8bit':
                     logger.info('found unknown charset: %s', t)
+                    supposition = None
                     try:
-                        supposition = detect(t[0])
+                        supposition = guess_charset(t[0])
                         logger.debug('trying to recover as %s', supposition)
-                        message.append(t[0].decode(supposition['encoding']))
-                    except:
+                        message.append(t[0].decode(supposition))
+                    except (TypeError, LookupError, UnicodeDecodeError):
                         logger.error('Failed to recover "%s" as %s', t[0],
                                      supposition)
                         raise ValueError('Incorrect encoding for Message: %s' %
@@ -146,24 +739,72 @@ class Message(MaildirMessage):
     @staticmethod
     def message_factory(message):
         m = Message(message)
-        logger.debug('Handling mail from %s with subject "%s"', m['From'],
-                     m['Subject'])
-        logger.debug(m['Date'])
-        try:
-            d = dateparse(m['Date'])
-        except ValueError:
+        if logger.isEnabledFor(DEBUG):
+            logger.debug('Handling mail from %s with subject "%s"', m['From'],
+                         m['Subject'])
+            logger.debug(m['Date'])
+        d = parse_date(m['Date'])
+        if d is None:
+            # Maildir.get_message sets the date of the file afterwards
             logger.warning('Mail from %s with subject "%s" Does not have a '
-                           '"Date" header! Some features will fail because of '
-                           'this!', m['From'], m['Subject'])
-            d = datetime.now()
-        m.set_date(d.timestamp())
+                           'valid "Date" header!', m['From'], m['Subject'])
+        else:
+            m.set_date(d)
         return m
 
     def __init__(self, *args, **kwargs):
         self.conditions_results = []
         self.mailbox = Optional[Mailbox]
+        self.loaded = True
+        self.headers_loaded = True
+        self._decoded = {}  # type: Dict[str, str]
         super().__init__(*args, **kwargs)
 
+    # methods modifying headers, which invalidate decoded values
+    def __setitem__(self, name, val):
+        self._decoded.clear()
+        super().__setitem__(name, val)
+
+    def __delitem__(self, name):
+        self._decoded.clear()
+        super().__delitem__(name)
+
+    def add_header(self, _name, _value, **_params):
+        self._decoded.clear()
+        super().add_header(_name, _value, **_params)
+
+    def replace_header(self, _name, _value):
+        self._decoded.clear()
+        super().replace_header(_name, _value)
+
+    def set_raw(self, name, value):
+        self._decoded.clear()
+        super().set_raw(name, value)
+
+    def set_boundary(self, boundary):
+        self._decoded.clear()
+        super().set_boundary(boundary)
+
+    def _become_message(self, message):
+        super()._become_message(message)
+        self._decoded = {}
+
+    def load(self) -> 'Message':
+        """
+        Reads the whole message from its mailbox if only its headers, or
+        only its flags, were loaded. Flags and subdir set on the message are
+        kept, as is its date once its headers were read.
+        """
+        if not self.loaded:
+            path = self.mailbox.get_path(self.key)
+            with open(path, 'rb') as f:
+                self._become_message(parse_message(f))
+            if not self.headers_loaded:
+                self.set_date(self.mailbox.date_of(self.key, path,
+                                                   parse_date(self['date'])))
+            self.loaded = self.headers_loaded = True
+        return self
+
     def exec_rule(self, rule):
         for cond in rule['conditions']:
             logger.debug("eval cond: %s", cond)
@@ -301,8 +942,9 @@ class Message(MaildirMessage):
         """
         Returns True if substring 'list' can be found in header List-Id
         """
-        if self.get_list():
-            return list_id in self.get_list(), self
+        list_name = self.get_list()
+        if list_name:
+            return list_id in list_name, self
         return False, self
 
     @condition
@@ -322,6 +964,49 @@ class Message(MaildirMessage):
             return True, self
         return False, self
 
+    @condition
+    def header_matches(self, header: str, regex: str) -> (bool, Message):
+        """
+        Returns True if regular expression 'regex' is found in header
+        'header'. A missing header does not match.
+
+        >>> m = Message()
+        >>> m['X-Mailer'] = 'Mutt 1.10'
+        >>> _ = m.header_matches('X-Mailer', r'^Mutt [0-9.]+$')
+        >>> m.conditions_results[-1]
+        True
+        >>> _ = m.header_matches('User-Agent', 'Mutt')
+        >>> m.conditions_results[-1]
+        False
+        >>> _ = m.header_matches('User-Agent', '.*')
+        >>> m.conditions_results[-1]
+        False
+        """
+        return (header in self and
+                re.search(regex, self[header]) is not None), self
+
+    @condition
+    def subject_matches(self, regex: str) -> (bool, Message):
+        """
+        Returns True if regular expression 'regex' is found in Subject: header
+
+        >>> m = Message()
+        >>> m['Subject'] = '[ticket #42] Printer on fire'
+        >>> _ = m.subject_matches('^.ticket #[0-9]+]')
+        >>> m.conditions_results[-1]
+        True
+        """
+        return ('subject' in self and
+                re.search(regex, self['subject']) is not None), self
+
+    @condition
+    def from_matches(self, regex: str) -> (bool, Message):
+        """
+        Returns True if regular expression 'regex' is found in From: header
+        """
+        return ('from' in self and
+                re.search(regex, self['from']) is not None), self
+
     # actions
     @action
     def mark_as_read(self) -> Message:
@@ -359,14 +1044,43 @@ class Message(MaildirMessage):
 
     @action
     def move_to(self, box: str) -> Message:
+        """
+        Moves the message to mailbox 'box'. Its file is renamed when both
+        mailboxes are on the same filesystem, and rewritten otherwise.
+        """
         box = get_mailbox(box)
+        if isinstance(self.mailbox, Mailbox):
+            try:
+                box.adopt(self)
+            except OSError as e:
+                logger.debug('cannot rename %s to %s, copying it: %s',
+                             self.key, box.name, e)
+            else:
+                self.mailbox = box
+                return self
+        self.load()
         key = box.add(self)
         self.delete()
         return box.get(key)
 
     @action
     def copy(self, box: str) -> Message:
+        """
+        Copies the message to mailbox 'box', as a hard link to its file when
+        possible.
+        """
         box = get_mailbox(box)
+        if isinstance(self.mailbox, Mailbox):
+            try:
+                key = box.adopt(self, link=True)
+            except OSError as e:
+                logger.debug('cannot link %s to %s, copying it: %s',
+                             self.key, box.name, e)
+            else:
+                copy = box.get_stub(key)
+                copy.set_date(self.get_date())
+                return copy
+        self.load()
         key = box.add(self)
         return box.get(key)
 
@@ -377,15 +1091,45 @@ class Message(MaildirMessage):
 
     @action
     def forward(self, command, forward_to, m_from=None):
+        """
+        Forwards the message to 'forward_to' through 'command', either a shell
+        command given the recipient as argument and the message on its
+        standard input, or the smtp://host[:port] URL of a relay. Messages
+        are queued when a delivery queue was started, see delivery.start().
+        A failed delivery is logged, and does not stop the run.
+
+        The file of the message is sent as is, its From:, To: and Subject:
+        headers rewritten, without being loaded. A message whose file is gone,
+        deleted by an earlier action or moved by another process, is not
+        forwarded.
+        """
         if type(command) is not str:
             logger.error("Trying to forward message %s without setting the "
                          "command to use!", command)
-        m = Message()
-        m['From'] = m_from or self['to']
-        m['To'] = forward_to
-        m['Subject'] = "Fwd: " + self['subject']
-        m.set_payload(self.get_payload())
-        run(command + " " + m['To'],
-            stdout=PIPE, input=m.as_string().encode('utf-8'),
-            shell=True, check=True)
+            return self
+        source = self
+        if isinstance(self.mailbox, Mailbox):
+            # kept open, so that forwarding still works if the message is
+            # moved or deleted before its delivery
+            try:
+                fp = open(self.mailbox.get_path(self.key), 'rb')
+            except (KeyError, FileNotFoundError) as e:
+                logger.error('cannot forward %s, it is gone from %s: %s',
+                             self.key, self.mailbox.name, e)
+                count('undelivered', self.mailbox.label)
+                return self
+            if not self.loaded:
+                # stubs and projections may lack the headers needed
+                source = Message(read_header_block(fp))
+                fp.seek(0)
+        else:
+            fp = BytesIO(self.as_bytes())
+        sender = m_from or source['to']
+        headers = b''.join(fold_header(name, value) for name, value in (
+            ('From', sender), ('To', forward_to),
+            ('Subject', "Fwd: " + source['subject'])))
+        deliver(command, parseaddr(sender)[1], forward_to,
+                Forwarded(fp, headers),
+                '%s/%s' % (getattr(self.mailbox, 'label', ''),
+                           getattr(self, 'key', '')))
         return self
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Tells whether any mailbox changed since the last run, from the mtimes of
+their directories, so that runs with nothing to do end before anything else
+is imported.
+"""
+import json
+import os
+from os.path import basename, dirname, join
+from time import time
+from typing import Dict, Iterable, Optional
+
+#: file of base_path where the mtimes seen by the last run are kept
+STATE_FILE = '.bureaucrate.state'
+#: mtimes more recent than this, in seconds, are not trusted: a change in
+#: the same tick of a coarse filesystem clock would go unnoticed. Same as
+#: mailbox.Maildir
+RESOLUTION = 2.1
+
+
+def snapshot(paths: Iterable[str],
+             now: Optional[float] = None) -> Optional[Dict[str, int]]:
+    """
+    Returns the mtimes of 'paths', in nanoseconds, or None if any of them
+    cannot be read or was modified too recently to be trusted
+    """
+    limit = ((now or time()) - RESOLUTION) * 1e9
+    mtimes = {}
+    for path in paths:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime > limit:
+            return None
+        mtimes[path] = mtime
+    return mtimes
+
+
+def load(path: str) -> Dict[str, int]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def unchanged(path: str, mtimes: Optional[Dict[str, int]]) -> bool:
+    """
+    Returns True if 'mtimes', a snapshot(), are those recorded in 'path'
+    """
+    if mtimes is None:
+        return False
+    recorded = load(path)
+    return all(recorded.get(p) == mtime for p, mtime in mtimes.items())
+
+
+def save(path: str, mtimes: Optional[Dict[str, int]]):
+    """
+    Records 'mtimes' in 'path', along with those of other paths recorded
+    there, as runs may be restricted to an account
+    """
+    if mtimes is None:
+        return
+    recorded = load(path)
+    recorded.update(mtimes)
+    tmp = join(dirname(path), '.%s.%d.tmp' % (basename(path), os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(recorded, f)
+    os.replace(tmp, path)
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import errno
+import os
+import select
+import struct
+from collections import OrderedDict
+from heapq import heappop, heappush
+from logging import getLogger
+from os.path import join
+from time import monotonic
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Inotify(object):
+    """
+    Minimal binding of the Linux inotify API
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        try:
+            inotify_init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32)
+        self.fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self, timeout: Optional[float] = None
+             ) -> List[Tuple[int, int, str]]:
+        """
+        Waits up to 'timeout' seconds, or forever if None, for events and
+        returns them as (watch descriptor, mask, name) tuples
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        events = []
+        while ready:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + size].rstrip(b'\0')
+                offset += size
+                events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """
+    Reports the files delivered or renamed into the new/ and cur/
+    directories of maildirs.
+    """
+
+    def __init__(self):
+        self.inotify = Inotify()
+        self.watches = {}  # type: Dict[int, Tuple[Hashable, str]]
+
+    def watch(self, path: str, tag: Hashable):
+        """
+        Watches the maildir at 'path', whose files are reported with 'tag'
+        """
+        for subdir in ('new', 'cur'):
+            wd = self.inotify.add_watch(join(path, subdir),
+                                        IN_CREATE | IN_MOVED_TO)
+            self.watches[wd] = (tag, subdir)
+
+    def wait(self, timeout: Optional[float] = None
+             ) -> Tuple[bool, Dict[Hashable, List[str]]]:
+        """
+        Waits for files to appear, and returns whether events were lost, in
+        which case every mailbox should be scanned, and the subpaths of the
+        files that appeared, by tag.
+        """
+        overflow = False
+        found = OrderedDict()  # type: Dict[Hashable, OrderedDict]
+        for wd, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflow, events were lost')
+                overflow = True
+                continue
+            if mask & (IN_IGNORED | IN_ISDIR) or wd not in self.watches:
+                continue
+            tag, subdir = self.watches[wd]
+            found.setdefault(tag, OrderedDict())[join(subdir, name)] = None
+        return overflow, {tag: list(paths) for tag, paths in found.items()}
+
+    def close(self):
+        self.inotify.close()
+
+
+class Scheduler(object):
+    """
+    Priority queue of tasks repeated on their own interval, keyed by their
+    next due time.
+
+    >>> now = [0]
+    >>> s = Scheduler(clock=lambda: now[0])
+    >>> s.add('INBOX', 60)
+    >>> s.add('Archives', 86400)
+    >>> s.timeout()
+    60
+    >>> now[0] = 61
+    >>> s.due()
+    ['INBOX']
+    >>> s.timeout()
+    59
+    """
+
+    def __init__(self, clock: Callable[[], float] = monotonic):
+        self.clock = clock
+        self.queue = []  # type: List[Tuple[float, int, float, Hashable]]
+        self.count = 0  # tie breaker, tags need not be comparable
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, tag: Hashable, interval: float):
+        if interval <= 0:
+            raise ValueError('interval must be positive: %s' % interval)
+        self.count += 1
+        heappush(self.queue, (self.clock() + interval, self.count, interval,
+                              tag))
+
+    def timeout(self) -> Optional[float]:
+        """
+        Returns the time until the next task is due, or None if there is none
+        """
+        if not self.queue:
+            return None
+        return max(0, self.queue[0][0] - self.clock())
+
+    def due(self) -> List[Hashable]:
+        """
+        Returns the tags of the tasks due, and schedules their next run
+        """
+        now = self.clock()
+        tags = []
+        while self.queue and self.queue[0][0] <= now:
+            due, count, interval, tag = heappop(self.queue)
+            tags.append(tag)
+            due += interval
+            if due <= now:
+                # missed runs are not caught up on
+                due = now + interval
+            heappush(self.queue, (due, count, interval, tag))
+        return tags
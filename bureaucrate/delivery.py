@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from logging import getLogger
+from threading import BoundedSemaphore, Lock, local
+from typing import BinaryIO, Iterator
+
+from .stats import count
+
+logger = getLogger(__name__)
+
+
+class CommandError(Exception):
+    """
+    Raised when the command of a transport exits with an error status
+    """
+
+
+#: errors of a delivery which do not stop the run. Those of smtplib are
+#: OSErrors
+DELIVERY_ERRORS = (OSError, CommandError)
+#: headers of forwarded messages replaced by those of the forward, or
+#: dropped: relays reject messages which they already delivered
+#: (Delivered-To)
+FORWARD_DROPPED = frozenset(('from', 'to', 'cc', 'bcc', 'subject',
+                             'return-path', 'delivered-to'))
+#: bytes sent at once to SMTP relays
+CHUNK_SIZE = 65536
+
+
+class Forwarded(object):
+    """
+    A message read from the binary file 'fp' a line at a time, with
+    'headers' in place of its FORWARD_DROPPED headers
+
+    >>> from io import BytesIO
+    >>> raw = (b'From: a@b\\nTo: c@d\\nX-Spam: no,\\n really\\n'
+    ...        b'Subject: hi\\n there\\n\\nTo: body\\n')
+    >>> b''.join(Forwarded(BytesIO(raw), b'To: e@f\\n'))
+    b'To: e@f\\nX-Spam: no,\\n really\\n\\nTo: body\\n'
+    """
+
+    def __init__(self, fp: BinaryIO, headers: bytes):
+        self.fp = fp
+        self.headers = headers
+
+    def __iter__(self) -> Iterator[bytes]:
+        # a line at a time, as transports end each with their own newline
+        yield from self.headers.splitlines(keepends=True)
+        dropped = False
+        for line in self.fp:
+            if line in (b'\n', b'\r\n'):
+                yield line
+                break
+            # continuation lines belong to the previous header
+            if line[:1] not in (b' ', b'\t'):
+                name = line.split(b':', 1)[0].strip().lower()
+                dropped = name.decode('ascii', 'replace') in FORWARD_DROPPED
+            if not dropped:
+                yield line
+        yield from self.fp
+
+    def close(self):
+        self.fp.close()
+
+
+class CommandTransport(object):
+    """
+    Delivers messages by running a shell command, given the recipient as
+    argument and the message on its standard input
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+
+    def send(self, sender: str, recipient: str, message: Forwarded):
+        # only imported when forwarding, like smtplib below, as both take a
+        # while to import
+        from subprocess import DEVNULL, PIPE, Popen
+        process = Popen(self.command + ' ' + recipient, stdin=PIPE,
+                        stdout=DEVNULL, shell=True)
+        try:
+            with process.stdin as stdin:
+                for line in message:
+                    stdin.write(line)
+        except BrokenPipeError:
+            # the command did not read the whole message: its status tells
+            # whether it failed
+            pass
+        if process.wait():
+            raise CommandError("'%s' exited with status %d" % (
+                process.args, process.returncode))
+
+    def close(self):
+        pass
+
+
+class SMTPTransport(object):
+    """
+    Delivers messages to an SMTP relay over a single connection, opened on
+    the first message and reopened when the relay closes it
+    """
+
+    def __init__(self, host='localhost', port=25):
+        self.host = host
+        self.port = port
+        #: smtplib.SMTP connection, if open
+        self.smtp = None
+
+    def send(self, sender: str, recipient: str, message: Forwarded):
+        import smtplib
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+        try:
+            self._envelope(sender, recipient)
+        except smtplib.SMTPServerDisconnected:
+            # idle connections get closed by relays: retry once on a new
+            # one, as nothing of the message was sent yet
+            self.smtp = smtplib.SMTP(self.host, self.port)
+            self._envelope(sender, recipient)
+        try:
+            self._data(message)
+        except Exception:
+            # the relay may still be waiting for the end of the message
+            self.smtp.close()
+            self.smtp = None
+            raise
+
+    def _envelope(self, sender: str, recipient: str):
+        import smtplib
+        try:
+            code, response = self.smtp.mail(sender)
+            if code != 250:
+                raise smtplib.SMTPSenderRefused(code, response, sender)
+            code, response = self.smtp.rcpt(recipient)
+            if code not in (250, 251):
+                raise smtplib.SMTPRecipientsRefused(
+                    {recipient: (code, response)})
+        except (smtplib.SMTPResponseException,
+                smtplib.SMTPRecipientsRefused):
+            self.smtp.rset()
+            raise
+
+    def _data(self, message: Forwarded):
+        """
+        Sends the DATA of 'message' in chunks, as smtplib only sends
+        messages held in memory
+        """
+        import smtplib
+        code, response = self.smtp.docmd('data')
+        if code != 354:
+            self.smtp.rset()
+            raise smtplib.SMTPDataError(code, response)
+        chunk = []
+        size = 0
+        for line in message:
+            line = line.rstrip(b'\r\n')
+            if line.startswith(b'.'):
+                line = b'.' + line
+            chunk.append(line + b'\r\n')
+            size += len(line) + 2
+            if size >= CHUNK_SIZE:
+                self.smtp.send(b''.join(chunk))
+                chunk, size = [], 0
+        chunk.append(b'.\r\n')
+        self.smtp.send(b''.join(chunk))
+        code, response = self.smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except DELIVERY_ERRORS:
+                pass
+            self.smtp = None
+
+
+def transport_for(spec: str):
+    """
+    Returns the transport described by 'spec', either an smtp://host[:port]
+    URL or a shell command
+
+    >>> t = transport_for('smtp://relay.example.com:2525')
+    >>> t.host, t.port
+    ('relay.example.com', 2525)
+    >>> transport_for('/usr/sbin/sendmail -i').command
+    '/usr/sbin/sendmail -i'
+    """
+    if spec.startswith('smtp://'):
+        from urllib.parse import urlsplit
+        url = urlsplit(spec)
+        return SMTPTransport(url.hostname or 'localhost', url.port or 25)
+    return CommandTransport(spec)
+
+
+def send(transport, sender: str, recipient: str, message: Forwarded,
+         label: str) -> bool:
+    """
+    Sends 'message' through 'transport', and closes it. A failure is logged
+    and counted against the mailbox of 'label', an account/mailbox/key name,
+    and False is returned.
+    """
+    try:
+        transport.send(sender, recipient, message)
+        return True
+    except DELIVERY_ERRORS as e:
+        logger.error('failed to forward %s to %s: %s', label, recipient, e)
+        count('undelivered', label.rpartition('/')[0])
+        return False
+    finally:
+        message.close()
+
+
+class DeliveryQueue(object):
+    """
+    Delivers messages from a pool of 'workers' threads, so that rules are
+    evaluated while messages are being sent. Each thread keeps its
+    transports, and thus its SMTP connections, open until close().
+
+    At most twice as many messages as there are workers wait to be sent,
+    each holding its file open: submit() blocks beyond that.
+    """
+
+    def __init__(self, workers=4):
+        self.pool = ThreadPoolExecutor(workers)
+        self.slots = BoundedSemaphore(workers * 2)
+        self.local = local()
+        self.lock = Lock()
+        #: transports of every worker, closed by close()
+        self.transports = []
+        #: futures of the messages not delivered yet
+        self.pending = set()
+        self.failures = 0
+
+    def submit(self, spec: str, sender: str, recipient: str,
+               message: Forwarded, label: str):
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(self._deliver, spec, sender, recipient,
+                                      message, label)
+        except Exception:
+            # as when the pool was shut down
+            self.slots.release()
+            message.close()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(partial(self._done, message, label))
+
+    def _done(self, message: Forwarded, label: str, future):
+        # errors which send() does not expect are only found here
+        error = future.exception()
+        if error is not None:
+            logger.error('failed to forward %s: %r', label, error)
+            count('undelivered', label.rpartition('/')[0])
+            message.close()
+        with self.lock:
+            self.pending.discard(future)
+            if error is not None:
+                self.failures += 1
+        self.slots.release()
+
+    def _deliver(self, spec: str, sender: str, recipient: str,
+                 message: Forwarded, label: str):
+        transports = getattr(self.local, 'transports', None)
+        if transports is None:
+            # by spec, for this worker only
+            transports = self.local.transports = {}
+        transport = transports.get(spec)
+        if transport is None:
+            transport = transports[spec] = transport_for(spec)
+            with self.lock:
+                self.transports.append(transport)
+        if not send(transport, sender, recipient, message, label):
+            with self.lock:
+                self.failures += 1
+
+    def flush(self) -> int:
+        """
+        Waits for the queued messages to be sent, and returns how many could
+        not be since the last call
+        """
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        with self.lock:
+            failures, self.failures = self.failures, 0
+        return failures
+
+    def close(self) -> int:
+        failures = self.flush()
+        self.pool.shutdown()
+        for transport in self.transports:
+            transport.close()
+        return failures
+
+
+#: queue of the forwarded messages, if delivery is pooled. See start()
+queue = None
+
+
+def start(workers=4) -> DeliveryQueue:
+    """
+    Makes forward queue messages, to be delivered by 'workers' threads
+    """
+    global queue
+    queue = DeliveryQueue(workers)
+    return queue
+
+
+def stop() -> int:
+    """
+    Delivers the queued messages, closes the transports and returns the
+    number of messages which could not be delivered
+    """
+    global queue
+    if queue is None:
+        return 0
+    failures, queue = queue.close(), None
+    return failures
+
+
+def deliver(spec: str, sender: str, recipient: str, message: Forwarded,
+            label: str):
+    """
+    Queues a message for delivery to 'recipient' through the transport of
+    'spec', or sends it right away if no queue was started
+    """
+    if queue is not None:
+        queue.submit(spec, sender, recipient, message, label)
+        return
+    transport = transport_for(spec)
+    try:
+        send(transport, sender, recipient, message, label)
+    finally:
+        transport.close()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+from logging import getLogger
+from os import stat_result
+from threading import Lock
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+logger = getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox TEXT NOT NULL,
+    key TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    info TEXT NOT NULL,
+    date REAL,
+    "from" TEXT,
+    subject TEXT,
+    list_id TEXT,
+    x_spam TEXT,
+    PRIMARY KEY (mailbox, key)
+);
+CREATE TABLE IF NOT EXISTS seen (
+    mailbox TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (mailbox, name)
+);
+"""
+#: bumped when SCHEMA changes. Indexed messages are dropped on a mismatch, as
+#: they can be read again, while the watermarks are kept.
+SCHEMA_VERSION = 1
+
+
+class Index(object):
+    """
+    On-disk cache of the metadata of the messages of an account, stored as a
+    sqlite database in the account directory.
+
+    Entries are keyed by mailbox and maildir unique name, and are only valid
+    as long as the mtime and size of the message file did not change.
+
+    It also records, per mailbox, the watermark of the last run: the file
+    names of the messages already processed. In incremental mode, only
+    messages which arrived, were moved in or had their flags changed since
+    are evaluated, unless 'full' is set. The watermark is left untouched
+    unless 'record' is set.
+
+    Writes are buffered until commit(), so that the database stays unlocked
+    while mailboxes are scanned, possibly by several processes at once.
+    Lookups may be done from the prefetch threads of a Mailbox.
+    """
+
+    FILENAME = '.bureaucrate.sqlite'
+    #: headers stored in the index, and the columns holding them
+    HEADERS = (('From', 'from'), ('Subject', 'subject'),
+               ('List-Id', 'list_id'), ('X-Spam', 'x_spam'))
+    #: the Date header is stored parsed, in the date column
+    INDEXED_HEADERS = frozenset(h.lower() for h, _ in HEADERS) | {'date'}
+
+    def __init__(self, path: str, cache_headers=True, incremental=False,
+                 full=False, record=True):
+        self.path = path
+        self.cache_headers = cache_headers
+        self.incremental = incremental
+        self.full = full
+        self.record = record
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        version, = self.db.execute('PRAGMA user_version').fetchone()
+        if version != SCHEMA_VERSION:
+            self.db.execute('DROP TABLE IF EXISTS messages')
+            self.db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        #: rows of messages, and (info, mailbox, key) of flag changes, to be
+        #: written by commit()
+        self.pending = []
+        self.pending_info = []
+        logger.debug('opened index %s', path)
+
+    def get(self, mailbox: str, key: str, st: stat_result
+            ) -> Optional[Tuple[str, Optional[float], Dict[str, str]]]:
+        """
+        Returns the flags, Date header timestamp and decoded headers of
+        message 'key', or None if it is not indexed or has changed since.
+
+        >>> from os import stat
+        >>> idx = Index(':memory:')
+        >>> st = stat(__file__)
+        >>> idx.put('INBOX', 'k1', st, '2,S', 42.0, {'From': 'me'})
+        >>> idx.commit()
+        >>> idx.get('INBOX', 'k1', st)
+        ('2,S', 42.0, {'From': 'me'})
+        >>> idx.get('INBOX', 'k2', st)
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT mtime, size, info, date, "from", subject, list_id, '
+                'x_spam FROM messages WHERE mailbox = ? AND key = ?',
+                (mailbox, key)).fetchone()
+        if row is None or row[0] != st.st_mtime_ns or row[1] != st.st_size:
+            return None
+        headers = {}
+        for (header, _), value in zip(Index.HEADERS, row[4:]):
+            if value is not None:
+                headers[header] = value
+        return row[2], row[3], headers
+
+    def put(self, mailbox: str, key: str, st: stat_result, info: str,
+            date: Optional[float], headers: Dict[str, str]):
+        """
+        Stores the metadata of message 'key'
+        """
+        self.pending.append(
+            (mailbox, key, st.st_mtime_ns, st.st_size, info, date) +
+            tuple(headers.get(h) for h, _ in Index.HEADERS))
+
+    def set_info(self, mailbox: str, key: str, info: str):
+        """
+        Updates the flags of an indexed message, which live in its filename
+        and do not change its mtime.
+        """
+        self.pending_info.append((info, mailbox, key))
+
+    def prune(self, mailbox: str, keys: Iterable[str]):
+        """
+        Forgets the messages of 'mailbox' that are not in 'keys'
+
+        >>> from os import stat
+        >>> idx = Index(':memory:')
+        >>> st = stat(__file__)
+        >>> for k in ('k1', 'k2'):
+        ...     idx.put('INBOX', k, st, '', 42.0, {})
+        >>> idx.prune('INBOX', ['k2'])
+        >>> idx.get('INBOX', 'k1', st)
+        >>> idx.get('INBOX', 'k2', st)
+        ('', 42.0, {})
+        """
+        self._flush()
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS live (key TEXT '
+                        'PRIMARY KEY)')
+        self.db.execute('DELETE FROM live')
+        self.db.executemany('INSERT OR IGNORE INTO live VALUES (?)',
+                            ((k,) for k in keys))
+        self.db.execute('DELETE FROM messages WHERE mailbox = ? AND key NOT '
+                        'IN (SELECT key FROM live)', (mailbox,))
+
+    def get_seen(self, mailbox: str) -> Set[str]:
+        """
+        Returns the file names processed during the last run on 'mailbox'
+
+        >>> idx = Index(':memory:')
+        >>> idx.set_seen('INBOX', ['k1:2,S', 'k2'])
+        >>> sorted(idx.get_seen('INBOX'))
+        ['k1:2,S', 'k2']
+        >>> idx.set_seen('INBOX', ['k2'])
+        >>> idx.get_seen('INBOX')
+        {'k2'}
+        """
+        return {name for name, in self.db.execute(
+            'SELECT name FROM seen WHERE mailbox = ?', (mailbox,))}
+
+    def set_seen(self, mailbox: str, names: Iterable[str]):
+        """
+        Replaces the watermark of 'mailbox'
+        """
+        self._flush()
+        self.db.execute('DELETE FROM seen WHERE mailbox = ?', (mailbox,))
+        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)',
+                            ((mailbox, name) for name in names))
+
+    def add_seen(self, mailbox: str, names: Iterable[str]):
+        """
+        Adds 'names' to the watermark of 'mailbox'
+
+        >>> idx = Index(':memory:')
+        >>> idx.set_seen('INBOX', ['k1'])
+        >>> idx.add_seen('INBOX', ['k2'])
+        >>> sorted(idx.get_seen('INBOX'))
+        ['k1', 'k2']
+        """
+        self._flush()
+        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)',
+                            ((mailbox, name) for name in names))
+
+    def _flush(self):
+        self.db.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, '
+                            '?, ?, ?, ?, ?, ?, ?)', self.pending)
+        self.db.executemany('UPDATE messages SET info = ? WHERE mailbox = ? '
+                            'AND key = ?', self.pending_info)
+        self.pending = []
+        self.pending_info = []
+
+    def commit(self):
+        self._flush()
+        self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
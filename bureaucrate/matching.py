@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from typing import FrozenSet, Iterable
+
+
+class Automaton(object):
+    """
+    Aho-Corasick automaton finding which of a set of strings occur in a text,
+    in a single pass over it.
+
+    >>> a = Automaton(['he', 'she', 'his', 'hers'])
+    >>> sorted(a.search('ushers'))
+    ['he', 'hers', 'she']
+    >>> a.search('hi')
+    frozenset()
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        # state 0 is the root, reached by the empty prefix
+        # transitions by character, and failure links, of each state
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]  # patterns ending at each state
+        for pattern in patterns:
+            self._insert(pattern)
+        self._link()
+        self.output = [frozenset(o) for o in self.output]
+
+    def _insert(self, pattern: str):
+        state = 0
+        for char in pattern:
+            following = self.goto[state].get(char)
+            if following is None:
+                following = len(self.goto)
+                self.goto[state][char] = following
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+            state = following
+        self.output[state].add(pattern)
+
+    def _link(self):
+        # breadth first, so that the failure state of a state, which is
+        # shallower, is complete when it is reached
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self.goto[state].items():
+                queue.append(following)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[following] = target if target != following else 0
+                self.output[following] |= self.output[self.fail[following]]
+
+    def search(self, text: str) -> FrozenSet[str]:
+        """
+        Returns the patterns which are substrings of 'text'
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set(output[0])
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return frozenset(found)
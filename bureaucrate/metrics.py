@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+from collections import OrderedDict
+from os.path import basename, dirname, join
+from time import time
+from typing import List, Tuple
+
+from .stats import Stats
+
+#: metric name and help of the mailbox counters, by Stats kind
+MAILBOX_METRICS = {
+    'scanned': ('bureaucrate_messages_scanned',
+                'Messages evaluated against the rules of a mailbox'),
+    'parsed': ('bureaucrate_messages_parsed',
+               'Messages whose headers were read from their file'),
+    'skipped': ('bureaucrate_messages_skipped',
+                'Messages not evaluated, as already seen in incremental '
+                'mode'),
+    'errors': ('bureaucrate_parse_errors',
+               'Headers which could not be decoded'),
+    'undelivered': ('bureaucrate_forward_failures',
+                    'Messages which could not be forwarded'),
+}
+
+
+def escape(value: str) -> str:
+    """
+    Escapes a label value
+
+    >>> print(escape('say "hi"\\n'))
+    say \\"hi\\"\\n
+    """
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def sample(name: str, labels: List[Tuple[str, str]], value) -> str:
+    """
+    >>> sample('up', [('account', 'main')], 1)
+    'up{account="main"} 1'
+    """
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (k, escape(v))
+                                  for k, v in labels)
+    return '%s %s' % (name, value)
+
+
+def mailbox_labels(label: str) -> List[Tuple[str, str]]:
+    account, _, mailbox = label.partition('/')
+    return [('account', account), ('mailbox', mailbox)]
+
+
+def render(stats: Stats, success: bool, now: float) -> str:
+    """
+    Returns the metrics of a run in the Prometheus text format
+
+    >>> s = Stats()
+    >>> s.add('scanned', 'main/INBOX', calls=3)
+    >>> s.add('rule', 'main/INBOX #1: if read then star', hit=True)
+    >>> s.add('action', 'star')
+    >>> s.add('account', 'main', 1.5)
+    >>> print(render(s, True, 1534752000.0), end='')
+    # HELP bureaucrate_account_duration_seconds Time spent on each account
+    # TYPE bureaucrate_account_duration_seconds gauge
+    bureaucrate_account_duration_seconds{account="main"} 1.5
+    # HELP bureaucrate_actions Actions run, by type
+    # TYPE bureaucrate_actions gauge
+    bureaucrate_actions{action="star"} 1
+    # HELP bureaucrate_rule_hits Messages matching each rule
+    # TYPE bureaucrate_rule_hits gauge
+    bureaucrate_rule_hits{account="main",mailbox="INBOX",rule="1",\
+text="if read then star"} 1
+    # HELP bureaucrate_messages_scanned Messages evaluated against the rules \
+of a mailbox
+    # TYPE bureaucrate_messages_scanned gauge
+    bureaucrate_messages_scanned{account="main",mailbox="INBOX"} 3
+    # HELP bureaucrate_last_run_success Whether the last run succeeded
+    # TYPE bureaucrate_last_run_success gauge
+    bureaucrate_last_run_success 1
+    # HELP bureaucrate_last_run_timestamp_seconds When the last run ended
+    # TYPE bureaucrate_last_run_timestamp_seconds gauge
+    bureaucrate_last_run_timestamp_seconds 1534752000.0
+    """
+    # (description, sample lines) by metric
+    samples = OrderedDict()
+
+    def add(metric: str, description: str, labels, value):
+        samples.setdefault(metric, (description, []))[1].append(
+            sample(metric, labels, value))
+
+    for (kind, name), (calls, hits, seconds) in sorted(stats.entries.items()):
+        if kind in MAILBOX_METRICS:
+            metric, description = MAILBOX_METRICS[kind]
+            add(metric, description, mailbox_labels(name), calls)
+        elif kind == 'action':
+            add('bureaucrate_actions', 'Actions run, by type',
+                [('action', name)], calls)
+        elif kind == 'rule':
+            # named 'account/mailbox #number: rule'
+            mailbox, _, text = name.partition(': ')
+            mailbox, _, number = mailbox.rpartition(' #')
+            add('bureaucrate_rule_hits', 'Messages matching each rule',
+                mailbox_labels(mailbox) + [('rule', number), ('text', text)],
+                hits)
+        elif kind == 'account':
+            add('bureaucrate_account_duration_seconds',
+                'Time spent on each account', [('account', name)], seconds)
+    add('bureaucrate_last_run_success', 'Whether the last run succeeded', [],
+        int(success))
+    add('bureaucrate_last_run_timestamp_seconds', 'When the last run ended',
+        [], now)
+    lines = []
+    for metric, (description, values) in samples.items():
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s gauge' % metric)
+        lines.extend(values)
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path: str, stats: Stats, success: bool):
+    """
+    Writes the metrics of a run to 'path', for the textfile collector of the
+    Prometheus node exporter. The file is written aside and renamed, so that
+    it is never read half written.
+    """
+    tmp = join(dirname(path), '.%s.%d.tmp' % (basename(path), os.getpid()))
+    try:
+        with open(tmp, 'w') as f:
+            f.write(render(stats, success, time()))
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
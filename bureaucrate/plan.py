@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from itertools import groupby
+from logging import getLogger
+from typing import Iterator, List, Optional, Tuple
+
+from .bureaucrate import ACTIONS, Mailbox, Message, get_mailbox
+from .stats import timed
+
+logger = getLogger(__name__)
+
+# stages of a plan: actions keeping the message where it is run first, then
+# copies, moves and deletions, each grouped by destination mailbox
+IN_PLACE, COPY, MOVE, DELETE = range(4)
+STAGES = {'copy': COPY, 'move_to': MOVE, 'archive': MOVE, 'delete': DELETE}
+
+Step = Tuple[Message, str, tuple]
+
+
+def destination(message: Message, name: str, args: tuple) -> Optional[str]:
+    """
+    Returns the name of the mailbox action 'name' puts 'message' into
+
+    >>> m = Message()
+    >>> m.set_date(datetime(2018, 8, 20).timestamp())
+    >>> destination(m, 'archive', ())
+    'Archives.2018'
+    >>> destination(m, 'move_to', ('Lists',))
+    'Lists'
+    >>> destination(m, 'star', ())
+    """
+    if name == 'archive':
+        archive_format = args[0] if args else 'Archives.%Y'
+        return datetime.fromtimestamp(message.get_date()).strftime(
+            archive_format)
+    if name in ('move_to', 'copy'):
+        return args[0]
+    return None
+
+
+class Plan(object):
+    """
+    Actions collected by RuleSet.plan() while evaluating rules, to be run
+    afterwards grouped by stage and destination mailbox, so that each
+    destination is refreshed once.
+
+    Rules are all evaluated before any action runs: unlike RuleSet.apply(),
+    a rule does not see the effects of the actions of the previous ones.
+    Once a message is moved or deleted, its later moves and deletions are
+    dropped.
+
+    >>> plan = Plan()
+    >>> m = Message()
+    >>> m.key = 'k1'
+    >>> m.set_date(datetime(2018, 8, 20).timestamp())
+    >>> plan.add(m, 'archive', ())
+    >>> plan.add(m, 'mark_as_read', ())
+    >>> print(plan)
+    mark_as_read: k1
+    archive Archives.2018: k1
+    """
+
+    def __init__(self):
+        self.steps = []  # type: List[Step]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, message: Message, name: str, args: tuple):
+        self.steps.append((message, name, args))
+
+    def groups(self) -> Iterator[Tuple[Tuple[int, Optional[str]],
+                                       List[Step]]]:
+        """
+        Yields the steps of the plan grouped by stage and destination, in
+        the order they are run. Steps of a group keep their order.
+        """
+        keyed = sorted(
+            ((STAGES.get(name, IN_PLACE), destination(m, name, args) or '',
+              i, (m, name, args))
+             for i, (m, name, args) in enumerate(self.steps)),
+            key=lambda e: e[:3])
+        for (stage, dest), entries in groupby(keyed, lambda e: e[:2]):
+            yield (stage, dest or None), [e[3] for e in entries]
+
+    def apply(self):
+        gone = set()
+        for (stage, dest), steps in self.groups():
+            if dest is not None:
+                get_mailbox(dest)._refresh()
+            logger.debug('running %d actions to %s', len(steps), dest)
+            for message, name, args in steps:
+                if stage >= MOVE and id(message) in gone:
+                    logger.warning('message %s was already moved, not '
+                                   'running %s on it', message.key, name)
+                    continue
+                if name == 'archive':
+                    timed('action', name, ACTIONS['move_to'])(message, dest)
+                else:
+                    timed('action', name, ACTIONS[name])(message, *args)
+                if stage >= MOVE:
+                    gone.add(id(message))
+        self.steps = []
+
+    def __str__(self):
+        lines = []
+        for (stage, dest), steps in self.groups():
+            for message, name, args in steps:
+                target = ' '.join((name, dest) if dest else (name,) + args)
+                label = getattr(message, 'key', None)
+                if isinstance(message.mailbox, Mailbox):
+                    label = '%s/%s' % (message.mailbox.name, label)
+                lines.append('%s: %s' % (target, label))
+        return '\n'.join(lines)
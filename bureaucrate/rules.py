@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+import re
+from datetime import datetime
+from functools import lru_cache
+from logging import getLogger
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from .bureaucrate import (ACTIONS, CONDITIONS, ConditionError, Message,
+                          headers_needed)
+from .matching import Automaton
+from .plan import Plan
+from .stats import timed
+from .utils import (Config, InvalidConfigurationError, parse_timespec,
+                    time_based)
+
+logger = getLogger(__name__)
+
+Predicate = Callable[[Message], bool]
+
+#: conditions holding when their argument is a substring of a field of the
+#: message, and how to get that field
+LITERAL_CONDITIONS = {
+    'is_from': lambda m: m['from'],
+    'subject_has': lambda m: m['subject'],
+    'list_is': Message.get_list,
+}
+#: number of distinct arguments of such a condition, over the rules of a
+#: mailbox, from which they are matched all at once by an Automaton
+MIN_PATTERNS = 4
+#: conditions holding when their regular expression argument is found in a
+#: header, and that header. header_matches takes the header as argument.
+REGEX_CONDITIONS = {
+    'subject_matches': 'subject',
+    'from_matches': 'from',
+}
+#: regular expressions which cannot be combined with others: group
+#: references would point to the wrong group
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\\g<')
+
+
+@lru_cache(maxsize=None)
+def compile_regex(regex: str):
+    """
+    Compiles 'regex' once for all the rules using it
+
+    >>> compile_regex('a+') is compile_regex('a+')
+    True
+    >>> compile_regex('(')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+      ...
+    bureaucrate.utils.InvalidConfigurationError: invalid regular expression \
+'(': ...
+    """
+    try:
+        return re.compile(regex)
+    except re.error as e:
+        raise InvalidConfigurationError('invalid regular expression %r: %s' %
+                                        (regex, e))
+
+
+def regex_condition(cond: List[str]) -> Optional[Tuple[str, str]]:
+    """
+    Returns the lowercase header and the regular expression of the regex
+    condition 'cond', or None if it is not one
+
+    >>> regex_condition(['header_matches', 'X-Mailer', 'Mutt'])
+    ('x-mailer', 'Mutt')
+    >>> regex_condition(['subject_matches', '^Re:'])
+    ('subject', '^Re:')
+    """
+    if cond[0] == 'header_matches' and len(cond) == 3:
+        return cond[1].lower(), cond[2]
+    if cond[0] in REGEX_CONDITIONS and len(cond) == 2:
+        return REGEX_CONDITIONS[cond[0]], cond[1]
+    return None
+
+
+class Scanner(object):
+    """
+    Matches the arguments of the literal conditions of a set of rules against
+    a message at once: each field is scanned by an Automaton the first time a
+    rule needs it, and the result is kept for the next rules.
+
+    Likewise, the regular expressions a set of rules looks for in a header
+    are combined into one alternation. Most messages match none of them, and
+    are then rejected by a single search.
+
+    >>> scanner = Scanner([{'conditions': [['subject_has', s]]}
+    ...                    for s in ('Hi', 'there', 'Hello', '!')])
+    >>> m = Message()
+    >>> m['Subject'] = 'Hi there!'
+    >>> sorted(scanner.scan(m, 'subject_has'))
+    ['!', 'Hi', 'there']
+    >>> 'is_from' in scanner
+    False
+    """
+
+    def __init__(self, rules: List[dict]):
+        patterns = {}
+        regexes = {}
+        for rule in rules:
+            for cond in rule['conditions']:
+                if not cond:
+                    continue
+                if cond[0] in LITERAL_CONDITIONS and len(cond) == 2:
+                    patterns.setdefault(cond[0], set()).add(cond[1])
+                header_regex = regex_condition(cond)
+                if header_regex is not None:
+                    header, regex = header_regex
+                    regexes.setdefault(header, set()).add(regex)
+        self.automata = {name: Automaton(args)
+                         for name, args in patterns.items()
+                         if len(args) >= MIN_PATTERNS}
+        self.alternations = {}  # type: Dict[str, re.Pattern]
+        #: (header, regex) pairs covered by the alternations
+        self.combined = set()  # type: Set[Tuple[str, str]]
+        for header, alternatives in regexes.items():
+            alternatives = {r for r in alternatives
+                            if not GROUP_REFERENCE.search(r)}
+            alternation = self.combine(alternatives)
+            if alternation is not None:
+                self.alternations[header] = alternation
+                self.combined.update((header, r) for r in alternatives)
+        self.message = None  # type: Optional[Message]
+        self.found = {}  # type: Dict[str, FrozenSet[str]]
+        self.candidate = {}  # type: Dict[str, bool]
+
+    @staticmethod
+    def combine(regexes: Set[str]):
+        """
+        Returns a regular expression found wherever one of 'regexes' is, or
+        None if they cannot be combined or there is no point in doing so
+
+        >>> Scanner.combine({'a+', 'b'}).pattern
+        '(?:a+)|(?:b)'
+        >>> Scanner.combine({'(?i)a', 'b'})
+        """
+        if len(regexes) < 2:
+            return None
+        try:
+            return re.compile('|'.join('(?:%s)' % r for r in sorted(regexes)))
+        except re.error:
+            # as with global flags, only allowed at the start
+            return None
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.automata
+
+    def _track(self, message: Message):
+        # results are kept for the message being evaluated only
+        if message is not self.message:
+            self.message = message
+            self.found = {}
+            self.candidate = {}
+
+    def predicate(self, name: str, pattern: str) -> Predicate:
+        return lambda m: pattern in self.scan(m, name)
+
+    def scan(self, message: Message, name: str) -> FrozenSet[str]:
+        """
+        Returns the arguments of condition 'name' which hold for 'message'
+        """
+        self._track(message)
+        found = self.found.get(name)
+        if found is None:
+            found = self.automata[name].search(
+                LITERAL_CONDITIONS[name](message))
+            self.found[name] = found
+        return found
+
+    def may_match(self, message: Message, header: str) -> bool:
+        """
+        Returns False if none of the regular expressions combined for
+        'header' can be found in it
+        """
+        alternation = self.alternations[header]
+        self._track(message)
+        candidate = self.candidate.get(header)
+        if candidate is None:
+            # missing headers read as '', which some expressions match
+            candidate = (header in message and
+                         alternation.search(message[header]) is not None)
+            self.candidate[header] = candidate
+        return candidate
+
+
+def regex_predicate(header: str, regex: str,
+                    scanner: Optional[Scanner]) -> Predicate:
+    pattern = compile_regex(regex)
+    if scanner is None or (header, regex) not in scanner.combined:
+        scanner = None
+
+    def predicate(m: Message) -> bool:
+        if header not in m:
+            return False
+        if scanner is not None and not scanner.may_match(m, header):
+            return False
+        return pattern.search(m[header]) is not None
+
+    return predicate
+
+
+class Clock(object):
+    """
+    The time older_than conditions compare the dates of messages against,
+    shared by the rules compiled together. Setting it moves their cutoffs
+    along, without compiling the rules again.
+
+    >>> clock = Clock(datetime(2018, 8, 20))
+    >>> datetime.fromtimestamp(clock.cutoff('1d'))
+    datetime.datetime(2018, 8, 19, 0, 0)
+    >>> clock.set(datetime(2018, 8, 21))
+    >>> datetime.fromtimestamp(clock.cutoff('1d'))
+    datetime.datetime(2018, 8, 20, 0, 0)
+    """
+
+    def __init__(self, now: Optional[datetime] = None):
+        self.set(now)
+
+    def set(self, now: Optional[datetime] = None):
+        """
+        Sets the clock to 'now', or to the current time
+        """
+        self.now = now or datetime.now()
+        self.cutoffs = {}  # type: Dict[str, float]
+
+    def cutoff(self, timespec: str) -> float:
+        """
+        Returns the timestamp before which messages are older than
+        'timespec'
+        """
+        cutoff = self.cutoffs.get(timespec)
+        if cutoff is None:
+            cutoff = (self.now + parse_timespec(timespec)).timestamp()
+            self.cutoffs[timespec] = cutoff
+        return cutoff
+
+
+def compile_condition(cond: List[str], clock: Clock,
+                      scanner: Optional[Scanner] = None) -> Predicate:
+    """
+    Returns a predicate evaluating the condition 'cond', as parsed by
+    Config.parse_rule. Literal conditions known to 'scanner' are answered by
+    it, and regex conditions are prefiltered by its alternations. Dates are
+    compared against 'clock'.
+
+    >>> m = Message()
+    >>> m['From'] = "Sample <example@test.org>"
+    >>> compile_condition(['is_from', 'Sample'], Clock())(m)
+    True
+    >>> compile_condition(['is_from'], Clock())
+    Traceback (most recent call last):
+      ...
+    bureaucrate.utils.InvalidConfigurationError: is_from: wrong number of \
+arguments
+    """
+    name, args = cond[0], tuple(cond[1:])
+    if name == 'older_than':
+        if len(args) != 1:
+            raise InvalidConfigurationError('older_than: wrong number of '
+                                            'arguments')
+        timespec = args[0]
+        clock.cutoff(timespec)
+        return lambda m: m.get_date() < clock.cutoff(timespec)
+    if scanner is not None and name in scanner and len(args) == 1:
+        return scanner.predicate(name, args[0])
+    header_regex = regex_condition(cond)
+    if header_regex is not None:
+        return regex_predicate(header_regex[0], header_regex[1], scanner)
+    if name not in CONDITIONS:
+        raise InvalidConfigurationError('unknown condition: %s' % name)
+    test = CONDITIONS[name]
+    if test.__code__.co_argcount != len(args) + 1:
+        raise InvalidConfigurationError('%s: wrong number of arguments' % name)
+    if not args:
+        return lambda m: test(m)[0]
+    return lambda m: test(m, *args)[0]
+
+
+def compile_conditions(conditions: List[List[str]], clock: Clock,
+                       scanner: Optional[Scanner] = None) -> List[Predicate]:
+    """
+    Compiles the conditions of a rule. 'negate' is applied here to the
+    preceding condition, and empty conditions are dropped.
+
+    >>> m = Message()
+    >>> m.set_flags('S')
+    >>> [p(m) for p in compile_conditions([['read'], ['negate'], [],
+    ...                                    ['starred']], Clock())]
+    [False, False]
+    """
+    predicates = []
+    for cond in conditions:
+        if not cond:
+            continue
+        if cond[0] == 'negate':
+            if not predicates:
+                raise InvalidConfigurationError('negate needs a preceding '
+                                                'condition')
+            predicate = predicates.pop()
+            predicates.append(lambda m, p=predicate: not p(m))
+            continue
+        predicates.append(timed('condition', ' '.join(cond),
+                                compile_condition(cond, clock, scanner)))
+    return predicates
+
+
+def compile_actions(actions: List[List[str]]) -> List[Tuple[Callable, tuple]]:
+    compiled = []
+    for act in actions:
+        if not act:
+            continue
+        if act[0] not in ACTIONS:
+            raise InvalidConfigurationError('unknown action: %s' % act[0])
+        compiled.append((timed('action', act[0], ACTIONS[act[0]]),
+                         tuple(act[1:])))
+    return compiled
+
+
+def describe(rule: dict) -> str:
+    """
+    Returns rule 'rule' as written in the configuration
+
+    >>> describe(Config.parse_rule("if is_from 'a b' and read then star"))
+    'if is_from a b and read then star'
+    """
+    return 'if %s then %s' % (
+        ' and '.join(' '.join(c) for c in rule['conditions'] if c),
+        ' and '.join(' '.join(a) for a in rule['actions'] if a))
+
+
+class CompiledRule(object):
+    """
+    A rule whose conditions are evaluated in order, stopping at the first
+    one which does not hold. 'name' labels it in statistics.
+    """
+
+    def __init__(self, rule: dict, clock: Optional[Clock] = None,
+                 scanner: Optional[Scanner] = None, name=''):
+        self.rule = rule
+        self.predicates = compile_conditions(rule['conditions'],
+                                             clock or Clock(), scanner)
+        self.actions = compile_actions(rule['actions'])
+        self.matches = timed('rule', name or describe(rule), self.matches)
+
+    def matches(self, message: Message) -> bool:
+        try:
+            for predicate in self.predicates:
+                if not predicate(message):
+                    return False
+        except Exception as e:
+            raise ConditionError(e)
+        return True
+
+    def apply(self, message: Message) -> bool:
+        """
+        Runs the actions of the rule on 'message' if its conditions hold.
+        Returns whether they did.
+        """
+        if not self.matches(message):
+            return False
+        logger.debug('rule %s matched', self.rule)
+        for act, args in self.actions:
+            act(message, *args)
+        return True
+
+
+class RuleSet(object):
+    """
+    The compiled rules of a mailbox, named after it in statistics. Their
+    older_than conditions follow 'clock', or else the time 'now'.
+
+    >>> rules = RuleSet([Config.parse_rule('if read and negate then star')])
+    >>> m = Message()
+    >>> rules.apply(m)
+    >>> m.get_flags()
+    'F'
+    >>> rules.headers
+    frozenset()
+    """
+
+    def __init__(self, rules: List[dict], now: Optional[datetime] = None,
+                 name='', clock: Optional[Clock] = None):
+        self.name = name
+        self.clock = clock or Clock(now)
+        self.scanner = Scanner(rules)
+        self.rules = [CompiledRule(rule, self.clock, self.scanner,
+                                   '%s #%d: %s' % (name, i, describe(rule)))
+                      for i, rule in enumerate(rules, 1)]
+        headers = headers_needed(rules)
+        #: argument of Mailbox.messages: the headers to read
+        self.headers = True if headers is None else headers
+        #: whether messages must be evaluated again on each run
+        self.time_based = time_based(rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def apply(self, message: Message):
+        for rule in self.rules:
+            rule.apply(message)
+
+    def plan(self, message: Message, plan: Plan):
+        """
+        Adds the actions of the rules matching 'message' to 'plan' instead of
+        running them
+        """
+        for rule in self.rules:
+            if rule.matches(message):
+                for act, args in rule.actions:
+                    plan.add(message, act.__name__, args)
+
+
+def compile_config(conf: Config, now: Optional[datetime] = None
+                   ) -> Dict[Tuple[str, str], RuleSet]:
+    """
+    Compiles the rules of every mailbox of every account of 'conf', sharing
+    a Clock set to 'now'
+    """
+    clock = Clock(now)
+    return {(account, mailbox): RuleSet(conf.get('rules', [], mailbox,
+                                                 account),
+                                        name='%s/%s' % (account, mailbox),
+                                        clock=clock)
+            for account in conf.get_accounts()
+            for mailbox in conf.get_mailboxes(account)}
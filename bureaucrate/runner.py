@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Processing of the configured mailboxes, as run from the command line. Kept
+apart from __main__, so that runs with nothing to do do not import it.
+"""
+import logging
+from collections import namedtuple
+from datetime import datetime
+from logging.handlers import QueueHandler
+from os.path import expanduser, join
+from time import perf_counter, sleep
+from typing import Dict, List, Optional, Tuple
+
+from . import delivery, stats
+from .bureaucrate import Mailbox, activate, init, set_charsets
+from .daemon import Scheduler, Watcher
+from .plan import Plan
+from .rules import RuleSet, compile_config
+from .utils import Config, parse_bool, parse_int, parse_interval
+
+logger = logging.getLogger(__name__)
+
+#: outcome of the processing of an account by a worker process: messages
+#: maps its mailboxes to the number of messages processed in each
+Result = namedtuple('Result', 'account messages failed records planned stats')
+
+
+def configure(conf: Config):
+    """
+    Applies the global options of 'conf' which are not read per mailbox
+    """
+    charsets = conf.get('charsets')
+    if charsets:
+        set_charsets([c.strip() for c in charsets.strip('\'"').split(',')
+                      if c.strip()])
+
+
+def open_account(conf: Config, account: str, opts: dict
+                 ) -> Dict[str, Mailbox]:
+    return init(join(conf.get("base_path"), account),
+                use_index=parse_bool(conf.get('index', account=account)),
+                incremental=parse_bool(conf.get('incremental',
+                                                account=account)),
+                full=opts.get('full', False),
+                dry_run=opts.get('dry_run', False),
+                date_source=str(conf.get('date_source', 'mtime',
+                                         account=account)).strip('\'"'))
+
+
+def max_messages(conf: Config, opts: dict, account: str,
+                 mailbox: str) -> Optional[int]:
+    value = opts.get('max_messages') or conf.get('max_messages', None,
+                                                 mailbox, account)
+    return None if value is None else parse_int(value)
+
+
+def process_mailbox(box: Mailbox, rules: RuleSet, prefetch=0,
+                    plan: Optional[Plan] = None,
+                    limit: Optional[int] = None) -> int:
+    """
+    Applies 'rules' to the messages of 'box', and returns how many there were.
+    With prefetch, that many messages are read ahead in background threads.
+    With plan, actions are added to it instead of being run. With limit, at
+    most that many messages are processed. Rules depending on the age of
+    messages are applied to all of them, even in incremental mode.
+    """
+    box.prefetch = prefetch
+    box.full = rules.time_based
+    box.max_messages = limit
+    start = perf_counter()
+    count = 0
+    for message in box.messages(rules.headers):
+        if plan is None:
+            rules.apply(message)
+        else:
+            rules.plan(message, plan)
+        count += 1
+    if stats.current is not None:
+        stats.current.add('mailbox', rules.name or box.name,
+                          perf_counter() - start, calls=count)
+    return count
+
+
+def new_plan(opts: dict) -> Optional[Plan]:
+    return Plan() if opts.get('plan') or opts.get('dry_run') else None
+
+
+def run_plan(plan: Optional[Plan], opts: dict) -> str:
+    """
+    Runs the actions of 'plan', or only describes them in dry-run mode
+    """
+    if plan is None:
+        return ''
+    if opts.get('dry_run'):
+        return str(plan)
+    plan.apply()
+    return ''
+
+
+def flush_deliveries(name: str):
+    """
+    Waits for the messages forwarded while processing 'name' to be sent
+    """
+    if delivery.queue is not None:
+        failures = delivery.queue.flush()
+        if failures:
+            logger.warning('%s: %d messages could not be forwarded', name,
+                           failures)
+
+
+def process_account(conf: Config, rulesets: Dict[Tuple[str, str], RuleSet],
+                    account: str, opts: dict) -> Tuple[Dict[str, int], str]:
+    """
+    Processes the mailboxes of 'account' in order, so that messages moved
+    to a later one are evaluated by its rules as well. Returns the number
+    of messages processed per mailbox, and the actions of the dry run.
+    """
+    start = perf_counter()
+    acc = open_account(conf, account, opts)
+    plan = new_plan(opts)
+    counts = {}
+    for mailbox in conf.get_mailboxes(account):
+        counts[mailbox] = process_mailbox(
+            acc[mailbox], rulesets[account, mailbox],
+            parse_int(conf.get('prefetch', 0, mailbox, account)), plan,
+            max_messages(conf, opts, account, mailbox))
+    planned = run_plan(plan, opts)
+    flush_deliveries(account)
+    if stats.current is not None:
+        stats.current.add('account', account, perf_counter() - start)
+    return counts, planned
+
+
+class RecordList(QueueHandler):
+    """
+    Keeps log records in a list, ready to be sent to the parent process
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self.records = []  # type: List[logging.LogRecord]
+
+    def enqueue(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+# state of a worker process, set by init_worker
+worker = {}
+
+
+def init_worker(conf: Config, opts: dict, now: datetime):
+    worker['conf'] = conf
+    worker['opts'] = opts
+    if opts.get('profile') or opts.get('metrics'):
+        stats.enable()
+    delivery.start(parse_int(conf.get('forward_workers', 4)))
+    worker['rulesets'] = compile_config(conf, now)
+    configure(conf)
+    logging.getLogger(__package__).setLevel(opts.get('loglevel'))
+
+
+def run_task(account: str) -> Result:
+    """
+    Processes an account in a worker process, capturing its logs
+    """
+    handler = RecordList()
+    package_logger = logging.getLogger(__package__)
+    package_logger.addHandler(handler)
+    package_logger.propagate = False
+    counts, failed, planned = {}, False, ''
+    try:
+        counts, planned = process_account(worker['conf'], worker['rulesets'],
+                                          account, worker['opts'])
+    except Exception:
+        logger.exception('failed to process %s', account)
+        failed = True
+    finally:
+        package_logger.removeHandler(handler)
+        package_logger.propagate = True
+    entries = {}
+    if stats.current is not None:
+        # sent along with each result, so that nothing is counted twice
+        entries, stats.current.entries = stats.current.entries, {}
+    return Result(account, counts, failed, handler.records, planned, entries)
+
+
+def process_parallel(conf: Config, accounts: List[str], jobs: int,
+                     opts: dict) -> bool:
+    """
+    Spreads 'accounts' over 'jobs' processes. Logs of the workers are
+    replayed here. Returns False if any account failed.
+
+    The mailboxes of an account are processed in order by the same worker,
+    as in serial runs: a message moved from one to a later one is evaluated
+    by the rules of both. Accounts are separate directories, so workers
+    never move messages into the same mailbox.
+    """
+    # multiprocessing takes a while to import
+    from concurrent.futures import ProcessPoolExecutor
+    ok = True
+    with ProcessPoolExecutor(jobs, initializer=init_worker,
+                             initargs=(conf, opts, datetime.now())) as pool:
+        for result in pool.map(run_task, accounts):
+            for record in result.records:
+                logging.getLogger(record.name).handle(record)
+            if result.planned:
+                print(result.planned)
+            for mailbox, count in result.messages.items():
+                logger.info('%s/%s: %d messages processed', result.account,
+                            mailbox, count)
+            if stats.current is not None:
+                stats.current.merge(result.stats)
+            ok = ok and not result.failed
+    return ok
+
+
+def run_daemon(conf: Config, rulesets: Dict[Tuple[str, str], RuleSet],
+               accounts: List[str], opts: dict) -> int:
+    """
+    Processes the configured mailboxes once, then the messages delivered or
+    moved into them as they appear, until interrupted. Mailboxes with a
+    'refresh' interval are also rescanned on that interval, which is the
+    only way they are processed when inotify is not available. As in other
+    modes, --plan runs the actions of each wake-up once all of its messages
+    were evaluated, and --dry-run only prints them.
+    """
+    scheduler = Scheduler()
+    everything = {(account, mailbox) for account in accounts
+                  for mailbox in conf.get_mailboxes(account)}
+    for account, mailbox in everything:
+        refresh = conf.get('refresh', None, mailbox, account)
+        if refresh is not None:
+            scheduler.add((account, mailbox), parse_interval(refresh))
+    try:
+        watcher = Watcher()
+    except OSError as e:
+        if not scheduler:
+            logger.error('cannot watch mailboxes: %s', e)
+            return 1
+        logger.warning('cannot watch mailboxes, only rescanning them on '
+                       'their refresh interval: %s', e)
+        watcher = None
+    opened = {}
+    for account in accounts:
+        opened[account] = open_account(conf, account, opts)
+        for mailbox in conf.get_mailboxes(account):
+            if watcher is not None:
+                watcher.watch(join(expanduser(conf.get('base_path')),
+                                   account, mailbox), (account, mailbox))
+    rescan, delivered = everything, {}
+    try:
+        while True:
+            # for older_than cutoffs to follow the time
+            for rules in rulesets.values():
+                rules.clock.set()
+            for account in accounts:
+                start = perf_counter()
+                activate(join(conf.get('base_path'), account),
+                         opened[account])
+                plan = new_plan(opts)
+                for mailbox in conf.get_mailboxes(account):
+                    rules = rulesets[account, mailbox]
+                    box = opened[account][mailbox]
+                    if (account, mailbox) in rescan:
+                        logger.info('scanning %s/%s', account, mailbox)
+                        try:
+                            process_mailbox(box, rules, parse_int(conf.get(
+                                'prefetch', 0, mailbox, account)), plan,
+                                max_messages(conf, opts, account, mailbox))
+                        except Exception:
+                            logger.exception('failed to process %s/%s',
+                                             account, mailbox)
+                        continue
+                    subpaths = delivered.get((account, mailbox), ())
+                    for subpath in subpaths:
+                        try:
+                            message = box.get_entry(subpath, rules.headers)
+                            if plan is None:
+                                rules.apply(message)
+                            else:
+                                rules.plan(message, plan)
+                        except FileNotFoundError:
+                            logger.debug('%s vanished from %s', subpath,
+                                         mailbox)
+                        except Exception:
+                            logger.exception('failed to process %s in %s',
+                                             subpath, mailbox)
+                    if subpaths:
+                        # not to be evaluated again by the next rescan
+                        box.record_seen(subpaths)
+                planned = run_plan(plan, opts)
+                if planned:
+                    print(planned)
+                flush_deliveries(account)
+                if stats.current is not None:
+                    stats.current.add('account', account,
+                                      perf_counter() - start)
+            if watcher is None:
+                sleep(scheduler.timeout())
+                overflow, delivered = False, {}
+            else:
+                overflow, delivered = watcher.wait(scheduler.timeout())
+            rescan = everything if overflow else set(scheduler.due())
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+def run(conf: Config, accounts: List[str], opts: dict) -> int:
+    """
+    Processes the mailboxes of 'accounts' as told by the command line
+    options 'opts', and returns the exit status
+    """
+    rulesets = compile_config(conf)
+    configure(conf)
+    delivery.start(parse_int(conf.get('forward_workers', 4)))
+    try:
+        if opts.get('daemon'):
+            return run_daemon(conf, rulesets, accounts, opts)
+        if opts.get('jobs') > 1:
+            ok = process_parallel(conf, accounts, opts.get('jobs'), opts)
+            return 0 if ok else 1
+        for account in accounts:
+            planned = process_account(conf, rulesets, account, opts)[1]
+            if planned:
+                print(planned)
+        return 0
+    finally:
+        delivery.stop()
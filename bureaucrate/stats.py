@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+#: kinds of entries whose hits are counted: the calls returning True
+HIT_KINDS = ('condition', 'rule')
+#: order of the kinds in reports. Besides timings, messages are counted per
+#: mailbox when 'scanned' by rules, 'parsed' from their file or 'skipped' in
+#: incremental mode, as are the headers which could not be decoded
+#: ('errors') and the messages which could not be forwarded ('undelivered').
+#: The runs of 'account' are timed.
+KINDS = ('account', 'mailbox', 'rule', 'condition', 'action', 'parse',
+         'decode', 'scanned', 'parsed', 'skipped', 'errors', 'undelivered')
+
+
+class Stats(object):
+    """
+    Call counts, hit counts and wall time collected during a run, by kind of
+    thing measured and name. Mailbox entries count messages instead of
+    calls. Entries may be added from several threads.
+
+    >>> s = Stats()
+    >>> s.add('condition', 'read', 0.5, True)
+    >>> s.add('condition', 'read', 0.25, False)
+    >>> s.entries[('condition', 'read')]
+    [2, 1, 0.75]
+    >>> s.as_dict()['condition']['read']['hit_rate']
+    0.5
+    """
+
+    def __init__(self):
+        #: [calls, hits, seconds] by (kind, name)
+        self.entries = {}  # type: Dict[Tuple[str, str], List]
+        self.lock = Lock()
+
+    def add(self, kind: str, name: str, seconds=0.0, hit=False, calls=1):
+        with self.lock:
+            entry = self.entries.get((kind, name))
+            if entry is None:
+                entry = self.entries[kind, name] = [0, 0, 0.0]
+            entry[0] += calls
+            entry[1] += hit
+            entry[2] += seconds
+
+    def merge(self, entries: Dict[Tuple[str, str], List]):
+        """
+        Adds the entries collected by another process
+        """
+        for (kind, name), (calls, hits, seconds) in entries.items():
+            self.add(kind, name, seconds, hits, calls)
+
+    def timed(self, kind: str, name: str, f: Callable) -> Callable:
+        """
+        Returns 'f' recording its calls, and whether they returned a true
+        value, under 'name'
+        """
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            result = f(*args, **kwargs)
+            self.add(kind, name, perf_counter() - start, bool(result))
+            return result
+        return wrapper
+
+    def as_dict(self) -> Dict[str, Dict[str, dict]]:
+        result = {}
+        for (kind, name), (calls, hits, seconds) in self.entries.items():
+            entry = {'calls': calls, 'seconds': seconds}
+            if kind in HIT_KINDS:
+                entry['hits'] = hits
+                entry['hit_rate'] = hits / calls if calls else None
+            result.setdefault(kind, {})[name] = entry
+        return result
+
+    def report(self) -> str:
+        """
+        Returns the entries as a table, by kind, slowest first
+
+        >>> s = Stats()
+        >>> s.add('rule', 'main/INBOX #1', 0.5, True)
+        >>> s.add('action', 'star', 0.25)
+        >>> print(s.report())
+        kind            calls     hits  seconds  name
+        rule                1   100.0%   0.5000  main/INBOX #1
+        action              1        -   0.2500  star
+        """
+        order = {kind: i for i, kind in enumerate(KINDS)}
+        lines = ['%-10s %10s %8s %8s  %s' % ('kind', 'calls', 'hits',
+                                             'seconds', 'name')]
+        for (kind, name), (calls, hits, seconds) in sorted(
+                self.entries.items(),
+                key=lambda e: (order.get(e[0][0], len(order)), -e[1][2])):
+            rate = ('%.1f%%' % (100.0 * hits / calls)
+                    if kind in HIT_KINDS and calls else '-')
+            lines.append('%-10s %10d %8s %8.4f  %s' % (kind, calls, rate,
+                                                       seconds, name))
+        return '\n'.join(lines)
+
+
+#: statistics of the current process, when collected. See enable()
+current = None
+
+
+def enable() -> Stats:
+    """
+    Starts collecting statistics in this process. Conditions and actions
+    are only measured when compiled afterwards.
+    """
+    global current
+    current = Stats()
+    return current
+
+
+def count(kind: str, name: str, calls=1):
+    """
+    Adds 'calls' to an entry of the current statistics, if collected
+    """
+    if current is not None:
+        current.add(kind, name, calls=calls)
+
+
+def timed(kind: str, name: str, f: Callable) -> Callable:
+    """
+    Returns 'f' recording its calls in the current statistics, or 'f' itself
+    when they are not collected
+    """
+    if current is None:
+        return f
+    return current.timed(kind, name, f)
+
+
+def measured(kind: str, name: str):
+    """
+    Decorator recording the calls of a function in the current statistics,
+    when they are collected
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if current is None:
+                return f(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                current.add(kind, name, perf_counter() - start)
+        return wrapper
+    return decorator
@@ -1,6 +1,23 @@
+import json
+import os
 import re
 from datetime import timedelta
+from logging import getLogger
+from os.path import abspath, basename, dirname, expanduser, join
 from shlex import split
+from zlib import crc32
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+from .changes import RESOLUTION
+
+logger = getLogger(__name__)
+
+#: version of the format of configuration caches, see Config.parse()
+CACHE_VERSION = 1
+#: lines opening an account or mailbox block, and setting an option
+BLOCK = re.compile(r'^ *(.*) \{$')
+OPTION = re.compile(r'^ *(?P<key>.*) = (?P<value>.*)$')
 
 
 def parse_timespec(timespec: str) -> timedelta:
@@ -27,10 +44,72 @@ def parse_timespec(timespec: str) -> timedelta:
     return timedelta(days=days, seconds=seconds)
 
 
+def parse_interval(value) -> float:
+    """
+    Returns the number of seconds in 'value', either a number of minutes or a
+    timespec
+
+    >>> parse_interval('1')
+    60.0
+    >>> parse_interval("'1d 12h'")
+    129600.0
+    """
+    value = str(value).strip('\'"')
+    if value.isdigit():
+        return int(value) * 60.0
+    return -parse_timespec(value).total_seconds()
+
+
+def parse_bool(value) -> bool:
+    """
+    Interprets a configuration value as a boolean
+
+    >>> parse_bool('yes'), parse_bool("'True'"), parse_bool('0')
+    (True, True, False)
+    >>> parse_bool(None)
+    False
+    """
+    return str(value).strip('\'"').lower() in ('1', 'yes', 'true', 'on')
+
+
+def time_based(rules: List[dict]) -> bool:
+    """
+    Returns True if the outcome of 'rules' changes as messages age, so that
+    messages seen by an earlier run must be evaluated again
+
+    >>> time_based([Config.parse_rule("if older_than '1d' then archive")])
+    True
+    >>> time_based([Config.parse_rule("if read then archive")])
+    False
+    """
+    return any(cond and cond[0] == 'older_than'
+               for rule in rules for cond in rule['conditions'])
+
+
+def parse_int(value) -> int:
+    """
+    Interprets a configuration value as an integer
+
+    >>> parse_int("'2'"), parse_int(4)
+    (2, 4)
+    """
+    return int(str(value).strip('\'"'))
+
+
 class InvalidConfigurationError(RuntimeError):
     pass
 
 
+def cache_path(path: str) -> str:
+    """
+    Returns the file where the configuration file 'path' is cached once
+    parsed, in $XDG_CACHE_HOME
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or expanduser('~/.cache')
+    name = '%08x' % crc32(abspath(path).encode('utf-8'))
+    return join(base, 'bureaucrate', 'config-%s.json' % name)
+
+
 class Config(object):
     """
     Parses a config file in a special format
@@ -44,21 +123,138 @@ class Config(object):
 
     def __init__(self):
         self.config = dict()
+        # settings by (account, mailbox) scope, see scopes()
+        self._scopes = None  # type: Optional[Dict[Tuple, dict]]
+        self._mailboxes = {}  # type: Dict[str, List[str]]
 
     def get_accounts(self):
-        return [k for k in self.config.keys()
-                if type(self.config[k]) == dict]
+        self.scopes()
+        return list(self._mailboxes)
 
     def get_mailboxes(self, account):
-        return [k for k in self.config[account].keys()
-                if type(self.config[account][k]) == dict]
+        self.scopes()
+        return self._mailboxes[account]
 
-    def parse(self, path: str):
+    def scopes(self) -> Dict[Tuple, dict]:
+        """
+        Returns the settings of every scope merged with those of the scopes
+        enclosing it, by (account, mailbox). The global scope is
+        (None, None), and that of an account (account, None).
+
+        >>> c = Config()
+        >>> ctx = Config.Context()
+        >>> for line in ['a = 1', 'acc {', 'b = 2', 'mb {', 'a = 3', '}', '}']:
+        ...     c.parse_line(line, ctx)
+        >>> sorted(c.scopes()['acc', 'mb'].items())
+        [('a', '3'), ('b', '2'), ('rules', [])]
+        """
+        if self._scopes is None:
+            settings = {k: v for k, v in self.config.items()
+                        if type(v) != dict}
+            scopes = {(None, None): settings}
+            mailboxes = {}
+            for account, options in self.config.items():
+                if type(options) != dict:
+                    continue
+                merged = dict(settings)
+                merged.update((k, v) for k, v in options.items()
+                              if type(v) != dict)
+                scopes[account, None] = merged
+                mailboxes[account] = []
+                for mailbox, mailbox_options in options.items():
+                    if type(mailbox_options) != dict:
+                        continue
+                    scopes[account, mailbox] = dict(merged)
+                    scopes[account, mailbox].update(mailbox_options)
+                    mailboxes[account].append(mailbox)
+            self._scopes, self._mailboxes = scopes, mailboxes
+        return self._scopes
+
+    def parse(self, path: str, cache: Optional[str] = None):
+        """
+        Parses the configuration file 'path'. With 'cache', the file where
+        it is kept once parsed, see cache_path(), it is only parsed again
+        once its contents change: its mtime and size are compared first,
+        then its hash.
+        """
+        if cache is None:
+            self._parse(path)
+            return
+        st = os.stat(path)
+        cached = self._read_cache(cache, path)
+        if (cached is not None and cached['mtime'] == st.st_mtime_ns and
+                cached['size'] == st.st_size):
+            self._restore(cached)
+            return
+        # only needed when the file was touched, and slow to import
+        from hashlib import sha256
+        with open(path, 'rb') as f:
+            digest = sha256(f.read()).hexdigest()
+        if cached is not None and cached['hash'] == digest:
+            self._restore(cached)
+        else:
+            self._parse(path)
+        self._write_cache(cache, {
+            'version': CACHE_VERSION,
+            'path': abspath(path),
+            # a change in the same tick of the clock would keep the mtime
+            'mtime': (st.st_mtime_ns
+                      if st.st_mtime < time() - RESOLUTION else None),
+            'size': st.st_size,
+            'hash': digest,
+            'config': self.config,
+            'scopes': [[account, mailbox, settings] for (account, mailbox),
+                       settings in self.scopes().items()],
+        })
+
+    def _parse(self, path: str):
         ctxt = Config.Context()
         with open(path) as f:
             for line in f.readlines():
                 self.parse_line(line, ctxt)
 
+    def _restore(self, cached: dict):
+        if self.config:
+            # added to an earlier configuration: scopes are merged again
+            self.config.update(cached['config'])
+            self._scopes = None
+            return
+        self.config = cached['config']
+        self._scopes, self._mailboxes = {}, {}
+        for account, mailbox, settings in cached['scopes']:
+            self._scopes[account, mailbox] = settings
+            if mailbox is not None:
+                self._mailboxes[account].append(mailbox)
+            elif account is not None:
+                self._mailboxes[account] = []
+
+    @staticmethod
+    def _read_cache(cache: str, path: str) -> Optional[dict]:
+        try:
+            with open(cache) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (type(cached) != dict or
+                cached.get('version') != CACHE_VERSION or
+                cached.get('path') != abspath(path)):
+            return None
+        return cached
+
+    @staticmethod
+    def _write_cache(cache: str, cached: dict):
+        tmp = join(dirname(cache), '.%s.%d.tmp' % (basename(cache),
+                                                   os.getpid()))
+        try:
+            os.makedirs(dirname(cache), exist_ok=True)
+            with open(tmp, 'w') as f:
+                # dumps() encodes in C, unlike dump()
+                f.write(json.dumps(cached))
+            os.replace(tmp, cache)
+        except OSError as e:
+            logger.debug('cannot cache the configuration in %s: %s', cache,
+                         e)
+
     def parse_line(self, line: str, context: Context):
         """
         >>> c = Config()
@@ -88,10 +284,11 @@ class Config(object):
         :param context:
         :return:
         """
+        self._scopes = None
         if line.strip().startswith('#'):
             # Then it is a comment, we ignore it
             return
-        match = re.match('^ *(.*) \{$', line)
+        match = BLOCK.match(line)
         if match:
             if context.glob:
                 if context.account is not None or context.mailbox is not None:
@@ -107,7 +304,7 @@ class Config(object):
                 self.config[context.account][context.mailbox] = {}
                 self.config[context.account][context.mailbox]['rules'] = []
                 return
-        match = re.match('^ *(?P<key>.*) = (?P<value>.*)$', line)
+        match = OPTION.match(line)
         if match:
             key, value = match.group('key'), match.group('value')
             if context.glob:
@@ -185,21 +382,9 @@ class Config(object):
         :param account: name of the account
         :return: something
         """
-        if account:
-            if mb:
-                if key in self.config[account][mb].keys():
-                    return self.config[account][mb][key]
-                if key in self.config[account].keys():
-                    return self.config[account][key]
-                if key in self.config.keys():
-                    return self.config[key]
-            if key in self.config[account].keys():
-                return self.config[account][key]
-            if key in self.config.keys():
-                return self.config[key]
-        if key in self.config.keys():
-            return self.config[key]
-        return default
+        if not account:
+            account = mb = None
+        return self.scopes()[account, mb or None].get(key, default)
 
     @classmethod
     def parse_rule(cls, line: str) -> dict:
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from benchmarks import bench, startup
+from benchmarks.corpus import generate
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_corpus(self):
+        stats = generate(self.tmp.name, 20, ('INBOX',), attachments=0.5,
+                         attachment_size=1024, missing_dates=0.5)
+        self.assertEqual(stats['messages'], 20)
+        self.assertEqual(len(listdir(join(self.tmp.name, 'INBOX', 'cur'))) +
+                         len(listdir(join(self.tmp.name, 'INBOX', 'new'))),
+                         20)
+
+    def test_report(self):
+        output = join(self.tmp.name, 'results.json')
+        bench.main(['--messages', '10', '--repeat', '1', '--only', 'init',
+                    '--only', 'ruleset_plan', '--only', 'action_move_to',
+                    '--output', output])
+        with open(output) as f:
+            report = json.load(f)
+        self.assertEqual(sorted(report['results']),
+                         ['action_move_to', 'init', 'ruleset_plan'])
+        self.assertEqual(report['results']['ruleset_plan']['items'], 20)
+        self.assertIn('peak_bytes', report['results']['init'])
+
+    def test_nothing_to_do(self):
+        config = startup.make_idle(self.tmp.name, messages=5)
+        self.assertEqual(startup.imported(config), [])
+        with open(join(self.tmp.name, startup.ACCOUNT, 'INBOX', 'new',
+                       'delivered'), 'wb') as f:
+            f.write(b'Subject: new\n\nbody\n')
+        self.assertIn('bureaucrate.bureaucrate', startup.imported(config))
+
+
+if __name__ == '__main__':
+    unittest.main()
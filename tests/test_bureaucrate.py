@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+import errno
+import unittest
+from mailbox import Maildir
+from os import stat, utime
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import time
+from unittest.mock import patch
+
+from bureaucrate import delivery, init, stats
+from bureaucrate.bureaucrate import Message, set_charsets
+from bureaucrate.daemon import Watcher
+from bureaucrate.rules import RuleSet
+from bureaucrate.runner import process_mailbox
+from bureaucrate.utils import Config
+
+SAMPLE = b"""From: Sample <example@test.org>
+To: me@test.org
+Subject: Hi there!
+Date: Mon, 20 Aug 2018 10:00:00 +0200
+
+Hello, this is the body.
+"""
+
+
+class TestMailbox(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.inbox = Maildir(join(self.tmp.name, 'INBOX'))
+        self.key = self.inbox.add(SAMPLE)
+        self.mailboxes = init(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_lazy_headers(self):
+        message, = list(self.mailboxes['INBOX'])
+        self.assertFalse(message.loaded)
+        self.assertEqual(message['subject'], 'Hi there!')
+        self.assertEqual(message.get_payload(), '')
+        message.load()
+        self.assertTrue(message.loaded)
+        self.assertEqual(message['subject'], 'Hi there!')
+        self.assertEqual(message.get_payload(), 'Hello, this is the body.\n')
+
+    def test_header_projection(self):
+        message, = list(self.mailboxes['INBOX'].messages({'subject'}))
+        self.assertEqual(message['subject'], 'Hi there!')
+        self.assertNotIn('from', message)
+        message.load()
+        self.assertEqual(message['from'], 'Sample <example@test.org>')
+
+    def test_prefetch(self):
+        for i in range(5):
+            self.inbox.add(SAMPLE.replace(b'Hi', b'Hi %d' % i))
+        box = self.mailboxes['INBOX']
+        expected = [m['subject'] for m in box]
+        box.prefetch = 2
+        self.assertEqual([m['subject'] for m in box], expected)
+
+    def test_flags_from_file_name(self):
+        message = self.inbox[self.key]
+        message.set_subdir('cur')
+        message.set_flags('FS')
+        self.inbox[self.key] = message
+        message, = list(self.mailboxes['INBOX'].messages(headers=False))
+        self.assertFalse(message.headers_loaded)
+        self.assertNotIn('subject', message)
+        self.assertEqual(message.get_flags(), 'FS')
+        self.assertIs(message.read().starred().conditions_results[-1], True)
+        message.load()
+        self.assertEqual(message['subject'], 'Hi there!')
+        self.assertEqual(message.get_flags(), 'FS')
+
+    def test_move_renames(self):
+        message, = list(self.mailboxes['INBOX'])
+        inode = stat(message.mailbox.get_path(message.key)).st_ino
+        message.mark_as_read()
+        moved = message.move_to('Archives')
+        path = moved.mailbox.get_path(moved.key)
+        self.assertEqual(stat(path).st_ino, inode)
+        self.assertTrue(path.endswith(':2,S'))
+        self.assertEqual(moved.load().get_payload(),
+                         'Hello, this is the body.\n')
+        self.assertEqual(len(self.mailboxes['INBOX']), 0)
+
+    def test_copy_links(self):
+        message, = list(self.mailboxes['INBOX'])
+        copy = message.copy('Archives')
+        self.assertEqual(stat(copy.mailbox.get_path(copy.key)).st_nlink, 2)
+        self.assertEqual(copy.load()['subject'], 'Hi there!')
+        self.assertEqual(len(self.mailboxes['INBOX']), 1)
+        # moved to where a copy already is, by a later run
+        message, = list(init(self.tmp.name)['INBOX'])
+        message.mark_as_read()
+        message.move_to('Archives')
+        archives = Maildir(join(self.tmp.name, 'Archives'))
+        self.assertEqual(sorted(m.get_flags() for m in archives), ['', 'S'])
+        self.assertEqual(len(Maildir(join(self.tmp.name, 'INBOX'))), 0)
+
+    def test_move_across_filesystems(self):
+        message, = list(self.mailboxes['INBOX'])
+        with patch('bureaucrate.bureaucrate.rename',
+                   side_effect=OSError(errno.EXDEV, 'cross-device link')):
+            moved = message.move_to('Archives')
+        self.assertEqual(moved.get_payload(), 'Hello, this is the body.\n')
+        self.assertEqual(len(self.mailboxes['INBOX']), 0)
+
+    def test_forward_streams_file(self):
+        key = self.inbox.add(SAMPLE.replace(b'Hello', b'Gr\xfc\xdf dich'))
+        out = join(self.tmp.name, 'forwarded')
+        delivery.start(1)
+        try:
+            for message in self.mailboxes['INBOX'].messages(False):
+                if message.key == key:
+                    message.forward('cat > %s; true' % out, 'you@test.org')
+                    # delivered from the file opened by forward
+                    message.delete()
+        finally:
+            self.assertEqual(delivery.stop(), 0)
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'From: me@test.org\n'
+                                       b'To: you@test.org\n'
+                                       b'Subject: Fwd: Hi there!\n'
+                                       b'Date: Mon, 20 Aug 2018 10:00:00 '
+                                       b'+0200\n\n'
+                                       b'Gr\xfc\xdf dich, this is the body.\n')
+
+
+    def test_forward_deleted(self):
+        profile = stats.enable()
+        self.addCleanup(setattr, stats, 'current', None)
+        message, = list(self.mailboxes['INBOX'])
+        message.delete()
+        with patch('bureaucrate.bureaucrate.deliver') as deliver:
+            self.assertIs(message.forward('true', 'you@test.org'), message)
+        deliver.assert_not_called()
+        self.assertEqual(
+            profile.entries[('undelivered', message.mailbox.label)][0], 1)
+
+
+class TestCharsets(unittest.TestCase):
+    def tearDown(self):
+        set_charsets([])
+
+    def subject(self, raw: bytes) -> str:
+        return Message(b'Subject: ' + raw + b'\n\nbody\n')['subject']
+
+    def test_unknown_8bit(self):
+        set_charsets(['iso-8859-15'])
+        self.assertEqual(self.subject('Réunion'.encode('utf-8')), 'Réunion')
+        self.assertEqual(self.subject('Réunion €'.encode('iso-8859-15')),
+                         'Réunion €')
+
+    def test_shadowed(self):
+        set_charsets(['shift_jis', 'iso-8859-15'])
+        self.assertNotEqual(self.subject('Réunion'.encode('iso-8859-15')),
+                            'Réunion')
+
+
+class TestDates(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.inbox = Maildir(join(self.tmp.name, 'INBOX'))
+        self.key = self.inbox.add(SAMPLE)
+        self.nodate = self.inbox.add(SAMPLE.replace(
+            b'Date: Mon, 20 Aug 2018 10:00:00 +0200\n', b''))
+        for key in (self.key, self.nodate):
+            utime(join(self.tmp.name, 'INBOX', self.inbox._lookup(key)),
+                  (1000000000, 1000000000))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dates(self, headers, **kwargs):
+        box = init(self.tmp.name, **kwargs)['INBOX']
+        return {m.key: m.get_date() for m in box.messages(headers)}
+
+    def test_mtime(self):
+        self.assertEqual(self.dates(False), {self.key: 1000000000,
+                                             self.nodate: 1000000000})
+
+    def test_delivery(self):
+        dates = self.dates(False, date_source='delivery')
+        self.assertEqual(dates[self.key], int(self.key.split('.')[0]))
+
+    def test_header(self):
+        for kwargs in ({}, {'use_index': True}, {'use_index': True}):
+            dates = self.dates(frozenset(), date_source='header', **kwargs)
+            self.assertEqual(dates[self.key], 1534752000)
+            self.assertEqual(dates[self.nodate],
+                             int(self.nodate.split('.')[0]))
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.inbox = Maildir(join(self.tmp.name, 'INBOX'))
+        self.key = self.inbox.add(SAMPLE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def messages(self):
+        return list(init(self.tmp.name, use_index=True)['INBOX']
+                    .messages({'from', 'subject'}))
+
+    def test_index_reused(self):
+        message, = self.messages()
+        self.assertEqual(message['from'], 'Sample <example@test.org>')
+        with patch('bureaucrate.bureaucrate.Mailbox._read_headers') as read:
+            message, = self.messages()
+            read.assert_not_called()
+        self.assertEqual(message['from'], 'Sample <example@test.org>')
+        self.assertEqual(message['subject'], 'Hi there!')
+        message.load()
+        self.assertEqual(message.get_payload(), 'Hello, this is the body.\n')
+
+    def test_undecodable_header(self):
+        profile = stats.enable()
+        self.addCleanup(setattr, stats, 'current', None)
+        self.inbox.add(SAMPLE.replace(b'Subject: Hi there!',
+                                      b'Subject: =?x-bogus?q?hi?='))
+        for _ in range(2):
+            box = init(self.tmp.name, use_index=True)['INBOX']
+            self.assertEqual([m['from'] for m in box.messages({'from'})],
+                             ['Sample <example@test.org>'] * 2)
+        # not decoded again once indexed
+        self.assertEqual(profile.entries[('errors', box.label)][0], 1)
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.inbox = Maildir(join(self.tmp.name, 'INBOX'))
+        self.inbox.add(SAMPLE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_only_new_messages(self):
+        self.assertEqual(len(list(init(self.tmp.name, incremental=True)
+                                  ['INBOX'])), 1)
+        self.assertEqual(list(init(self.tmp.name, incremental=True)
+                              ['INBOX']), [])
+        self.inbox.add(SAMPLE)
+        self.assertEqual(len(list(init(self.tmp.name, incremental=True)
+                                  ['INBOX'])), 1)
+        self.assertEqual(len(list(init(self.tmp.name, incremental=True,
+                                       full=True)['INBOX'])), 2)
+
+    def test_time_based_rules(self):
+        rules = RuleSet([Config.parse_rule("if older_than '1d' then "
+                                           "move_to Old")])
+        key, = self.inbox.keys()
+        self.assertEqual(process_mailbox(
+            init(self.tmp.name, incremental=True)['INBOX'], rules), 1)
+        self.assertEqual(len(self.inbox), 1)
+        past = time() - 10 * 86400
+        utime(join(self.tmp.name, 'INBOX', self.inbox._lookup(key)),
+              (past, past))
+        self.assertEqual(process_mailbox(
+            init(self.tmp.name, incremental=True)['INBOX'], rules), 1)
+        self.assertEqual(len(self.inbox), 0)
+        self.assertEqual(list(Maildir(join(self.tmp.name, 'Old')).keys()),
+                         [key])
+
+
+class TestListing(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.inbox = Maildir(join(self.tmp.name, 'INBOX'))
+        self.keys = [self.inbox.add(SAMPLE) for _ in range(5)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_inode_order(self):
+        box = init(self.tmp.name)['INBOX']
+        keys = [m.key for m in box.messages(False)]
+        self.assertEqual(sorted(keys), sorted(self.keys))
+        self.assertEqual(keys, sorted(keys, key=lambda k: stat(
+            box.get_path(k)).st_ino))
+
+    def test_unchanged_not_listed(self):
+        box = init(self.tmp.name)['INBOX']
+        self.assertEqual(len(list(box.messages(False))), 5)
+        box._last_read -= 10
+        with patch('bureaucrate.bureaucrate.scandir') as scan:
+            self.assertEqual(len(list(box.messages(False))), 5)
+        scan.assert_not_called()
+
+    def test_max_messages(self):
+        processed = []
+        for _ in range(3):
+            box = init(self.tmp.name, incremental=True)['INBOX']
+            box.max_messages = 2
+            processed.append(len(list(box.messages(False))))
+        self.assertEqual(processed, [2, 2, 1])
+
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.inbox = Maildir(join(self.tmp.name, 'INBOX'))
+        try:
+            self.watcher = Watcher()
+        except OSError as e:
+            self.skipTest(str(e))
+
+    def tearDown(self):
+        self.watcher.close()
+        self.tmp.cleanup()
+
+    def test_delivery(self):
+        self.watcher.watch(join(self.tmp.name, 'INBOX'), 'INBOX')
+        key = self.inbox.add(SAMPLE)
+        overflow, found = self.watcher.wait(5)
+        self.assertFalse(overflow)
+        self.assertEqual(found, {'INBOX': [join('new', key)]})
+        message = init(self.tmp.name)['INBOX'].get_entry(found['INBOX'][0])
+        self.assertEqual(message['subject'], 'Hi there!')
+
+
+if __name__ == '__main__':
+    unittest.main()
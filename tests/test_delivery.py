@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import socketserver
+import unittest
+from io import BytesIO
+from threading import Thread
+from unittest.mock import patch
+
+from bureaucrate import delivery, stats
+from bureaucrate.bureaucrate import Message
+
+
+class RelayHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of an SMTP server to accept messages
+    """
+
+    def reply(self, line: str):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 relay ready')
+        in_data, lines, data = False, [], []
+        for raw in self.rfile:
+            line = raw.decode('utf-8').rstrip('\r\n')
+            if in_data:
+                if line == '.':
+                    self.server.messages.append('\n'.join(lines))
+                    self.server.data.append(b''.join(data))
+                    in_data, lines, data = False, [], []
+                    self.reply('250 queued')
+                else:
+                    lines.append(line[1:] if line.startswith('.') else line)
+                    data.append(raw)
+                continue
+            verb = line[:4].upper()
+            if verb == 'DATA':
+                in_data = True
+                self.reply('354 go ahead')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            elif verb in ('EHLO', 'HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 ok')
+            else:
+                self.reply('502 not implemented')
+
+
+class Relay(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RelayHandler)
+        self.connections = 0
+        self.messages = []
+        #: DATA of the messages, as received
+        self.data = []
+
+
+class TestDelivery(unittest.TestCase):
+    def setUp(self):
+        self.relay = Relay()
+        Thread(target=self.relay.serve_forever, daemon=True).start()
+        self.url = 'smtp://127.0.0.1:%d' % self.relay.server_address[1]
+
+    def tearDown(self):
+        delivery.stop()
+        stats.current = None
+        self.relay.shutdown()
+        self.relay.server_close()
+
+    def test_connection_reused(self):
+        delivery.start(1)
+        for i in range(5):
+            message = delivery.Forwarded(
+                BytesIO(b'Subject: old\nX-Seq: %d\n\n.hidden\n' % i),
+                b'Subject: new\n')
+            delivery.deliver(self.url, 'me@test.net', 'you@test.net',
+                             message, 'main/INBOX/%d' % i)
+        self.assertEqual(delivery.stop(), 0)
+        self.assertEqual(self.relay.connections, 1)
+        self.assertEqual(len(self.relay.messages), 5)
+        self.assertEqual(self.relay.messages[0],
+                         'Subject: new\nX-Seq: 0\n\n.hidden')
+
+    def test_crlf_only(self):
+        delivery.start(1)
+        message = delivery.Forwarded(
+            BytesIO(b'Subject: old\nX-Long: a\n b\n\nbody\n'),
+            b'From: me@test.net\nTo: you@test.net\nSubject: new,\n folded\n')
+        delivery.deliver(self.url, 'me@test.net', 'you@test.net', message,
+                         'main/INBOX/1')
+        self.assertEqual(delivery.stop(), 0)
+        data, = self.relay.data
+        self.assertEqual(data.count(b'\n'), data.count(b'\r\n'))
+        self.assertEqual(self.relay.messages[0],
+                         'From: me@test.net\nTo: you@test.net\n'
+                         'Subject: new,\n folded\nX-Long: a\n b\n\nbody')
+
+    def test_submit_after_shutdown(self):
+        queue = delivery.start(1)
+        queue.pool.shutdown()
+        fp = BytesIO()
+        with self.assertRaises(RuntimeError):
+            delivery.deliver('true', 'me@test.net', 'you@test.net',
+                             delivery.Forwarded(fp, b''), 'main/INBOX/1')
+        self.assertTrue(fp.closed)
+        # the slot was given back: both of the single worker are free
+        for _ in range(2):
+            self.assertTrue(queue.slots.acquire(blocking=False))
+        for _ in range(2):
+            queue.slots.release()
+
+    def test_failures_counted(self):
+        profile = stats.enable()
+        delivery.start(2)
+        for i in range(3):
+            delivery.deliver('exit 1', 'me@test.net', 'you@test.net',
+                             delivery.Forwarded(BytesIO(), b''),
+                             'main/INBOX/%d' % i)
+        self.assertEqual(delivery.queue.flush(), 3)
+        self.assertEqual(profile.entries[('undelivered', 'main/INBOX')][0],
+                         3)
+
+    def test_unexpected_errors(self):
+        delivery.start(1)
+        fp = BytesIO(b'Subject: hi\n\nbody\n')
+        delivery.deliver(None, 'me@test.net', 'you@test.net',
+                         delivery.Forwarded(fp, b''), 'main/INBOX/1')
+        self.assertEqual(delivery.stop(), 1)
+        self.assertTrue(fp.closed)
+        with patch('bureaucrate.bureaucrate.deliver') as deliver:
+            Message().forward(None, 'you@test.net')
+        deliver.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import unittest
+from os import listdir
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from bureaucrate.metrics import write_textfile
+from bureaucrate.stats import Stats
+
+
+class TestTextfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replaced_atomically(self):
+        path = join(self.tmp.name, 'bureaucrate.prom')
+        with open(path, 'w') as f:
+            f.write('old\n')
+        s = Stats()
+        s.add('errors', 'main/INBOX', calls=2)
+        write_textfile(path, s, False)
+        self.assertEqual(listdir(self.tmp.name), ['bureaucrate.prom'])
+        with open(path) as f:
+            text = f.read()
+        self.assertIn('bureaucrate_parse_errors{account="main",'
+                      'mailbox="INBOX"} 2\n', text)
+        self.assertIn('bureaucrate_last_run_success 0\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from mailbox import Maildir
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from bureaucrate import init
+from bureaucrate.plan import Plan
+from bureaucrate.rules import compile_config
+from bureaucrate.runner import process_account
+from bureaucrate.utils import Config
+
+SAMPLE = b"""From: Sample <example@test.org>
+To: me@test.org
+Subject: Hi there!
+
+Hello, this is the body.
+"""
+RULES = """base_path = %s
+main {
+    incremental = yes
+    INBOX {
+        if is_from 'Sample' then mark_as_read and move_to Archives
+    }
+}
+"""
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        os.mkdir(join(self.tmp.name, 'main'))
+        self.inbox = Maildir(join(self.tmp.name, 'main', 'INBOX'))
+        self.key = self.inbox.add(SAMPLE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def maildir(self, name: str) -> Maildir:
+        return Maildir(join(self.tmp.name, 'main', name))
+
+    def test_dry_run(self):
+        path = join(self.tmp.name, 'rc')
+        with open(path, 'w') as f:
+            f.write(RULES % self.tmp.name)
+        conf = Config()
+        conf.parse(path)
+        rulesets = compile_config(conf)
+        counts, planned = process_account(conf, rulesets, 'main',
+                                          {'dry_run': True})
+        self.assertEqual(counts, {'INBOX': 1})
+        self.assertEqual(planned.splitlines(),
+                         ['mark_as_read: INBOX/%s' % self.key,
+                          'move_to Archives: INBOX/%s' % self.key])
+        self.assertEqual(list(self.inbox.keys()), [self.key])
+        self.assertEqual(self.inbox[self.key].get_flags(), '')
+        self.assertEqual(len(self.maildir('Archives')), 0)
+        # not marked as seen: the next run evaluates it again
+        counts, planned = process_account(conf, rulesets, 'main', {})
+        self.assertEqual(counts, {'INBOX': 1})
+        self.assertEqual(planned, '')
+        self.assertEqual(len(self.inbox), 0)
+        self.assertEqual(self.maildir('Archives')[self.key].get_flags(), 'S')
+
+    def test_stages(self):
+        message, = list(init(join(self.tmp.name, 'main'))['INBOX'])
+        plan = Plan()
+        plan.add(message, 'move_to', ('Archives',))
+        plan.add(message, 'move_to', ('Trash',))
+        plan.add(message, 'mark_as_read', ())
+        plan.add(message, 'copy', ('Lists',))
+        self.assertEqual(str(plan).splitlines(),
+                         ['mark_as_read: INBOX/%s' % self.key,
+                          'copy Lists: INBOX/%s' % self.key,
+                          'move_to Archives: INBOX/%s' % self.key,
+                          'move_to Trash: INBOX/%s' % self.key])
+        with self.assertLogs('bureaucrate.plan', 'WARNING') as logs:
+            plan.apply()
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(len(plan), 0)
+        self.assertEqual(len(self.inbox), 0)
+        # marked as read first, so that the copy carries the flag too
+        self.assertEqual(self.maildir('Lists')[self.key].get_flags(), 'S')
+        self.assertEqual(self.maildir('Archives')[self.key].get_flags(), 'S')
+        self.assertEqual(len(self.maildir('Trash')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime
+
+from bureaucrate import stats
+from bureaucrate.bureaucrate import Message
+from bureaucrate.rules import RuleSet
+from bureaucrate.utils import Config
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.senders = ['alice@', 'bob@', 'carol@', 'test.org', 'nobody']
+        lines = ['if is_from %s then star' % s for s in self.senders]
+        lines.append('if is_from test.org and negate then mark_as_read')
+        self.rules = [Config.parse_rule(line) for line in lines]
+
+    def test_same_as_substring_tests(self):
+        rules = RuleSet(self.rules, datetime.now())
+        self.assertIn('is_from', rules.scanner)
+        for sender in ('bob@test.org', 'dave@example.com'):
+            m = Message()
+            m['From'] = sender
+            self.assertEqual([r.matches(m) for r in rules.rules],
+                             [s in sender for s in self.senders] +
+                             ['test.org' not in sender])
+
+    def test_few_patterns_not_scanned(self):
+        rules = RuleSet(self.rules[:2], datetime.now())
+        self.assertNotIn('is_from', rules.scanner)
+
+
+class TestRegex(unittest.TestCase):
+    def setUp(self):
+        lines = [r"if subject_matches '^\[ticket #\d+\]' then star",
+                 "if subject_matches 'urgent|asap' then star",
+                 r"if subject_matches '(\w+) \1' then star",
+                 "if header_matches X-Mailer '^Mutt' then mark_as_read"]
+        self.rules = RuleSet([Config.parse_rule(line) for line in lines],
+                             datetime.now())
+
+    def matches(self, **headers):
+        m = Message()
+        for header, value in headers.items():
+            m[header.replace('_', '-')] = value
+        return [r.matches(m) for r in self.rules.rules]
+
+    def test_alternation(self):
+        self.assertIn('subject', self.rules.scanner.alternations)
+        self.assertNotIn('x-mailer', self.rules.scanner.alternations)
+        self.assertEqual(self.matches(Subject='[ticket #42] asap'),
+                         [True, True, False, False])
+        self.assertEqual(self.matches(Subject='hello hello'),
+                         [False, False, True, False])
+        self.assertEqual(self.matches(Subject='nothing', X_Mailer='Mutt'),
+                         [False, False, False, True])
+
+    def test_missing_header(self):
+        rules = RuleSet([Config.parse_rule(line) for line in (
+            "if header_matches X-Foo '.*' then star",
+            "if from_matches '^$' then star",
+            "if subject_matches '^$' then star",
+            "if subject_matches 'x*' then star")], datetime.now())
+        self.assertIn('subject', rules.scanner.alternations)
+        m = Message()
+        self.assertEqual([r.matches(m) for r in rules.rules],
+                         [False] * 4)
+        m['X-Foo'] = m['From'] = m['Subject'] = ''
+        self.assertEqual([r.matches(m) for r in rules.rules],
+                         [True] * 4)
+
+    def test_headers_needed(self):
+        self.assertEqual(self.rules.headers, {'subject', 'x-mailer'})
+
+
+class TestClock(unittest.TestCase):
+    def test_cutoffs_follow_clock(self):
+        rules = RuleSet([Config.parse_rule("if older_than '1d' then star")],
+                        datetime(2018, 8, 20))
+        m = Message()
+        m.set_date(datetime(2018, 8, 19, 12).timestamp())
+        self.assertFalse(rules.rules[0].matches(m))
+        rules.clock.set(datetime(2018, 8, 21))
+        self.assertTrue(rules.rules[0].matches(m))
+
+
+class TestProfile(unittest.TestCase):
+    def tearDown(self):
+        stats.current = None
+
+    def test_counters(self):
+        profile = stats.enable()
+        rules = RuleSet([Config.parse_rule("if subject_has 'Hi' then star")],
+                        datetime.now(), 'main/INBOX')
+        for subject in ('Hi', 'Hello'):
+            m = Message()
+            m['Subject'] = subject
+            rules.apply(m)
+        self.assertEqual(
+            {key: entry[:2] for key, entry in profile.entries.items()},
+            {('rule', 'main/INBOX #1: if subject_has Hi then star'): [2, 1],
+             ('condition', 'subject_has Hi'): [2, 1],
+             ('action', 'star'): [1, 1],
+             ('decode', 'header'): [2, 0]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from mailbox import Maildir
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from bureaucrate import delivery, runner
+from bureaucrate.utils import Config
+
+SAMPLE = b"""From: Sample <example@test.org>
+To: me@test.org
+Subject: Hi there!
+
+Hello, this is the body.
+"""
+RULES = """base_path = %s
+main {
+    INBOX {
+        if is_from 'Sample' then mark_as_read and move_to Archives
+    }
+}
+"""
+
+PARALLEL = """base_path = %s
+main {
+    INBOX {
+        if is_from 'Sample' then move_to Lists
+    }
+    Lists {
+        if is_from 'Sample' then move_to Done
+    }
+}
+gone {
+    INBOX {
+        if read then star
+    }
+}
+"""
+
+FORWARD = """base_path = %s
+main {
+    incremental = yes
+    INBOX {
+        if is_from 'Sample' then forward 'cat >> %s; true' 'you@test.org'
+    }
+}
+"""
+
+
+def parse(path: str, text: str) -> Config:
+    with open(path, 'w') as f:
+        f.write(text)
+    conf = Config()
+    conf.parse(path)
+    return conf
+
+
+class IdleWatcher(object):
+    """
+    Stands in for daemon.Watcher, interrupting the daemon once it waits
+    """
+
+    def watch(self, path, tag):
+        pass
+
+    def wait(self, timeout=None):
+        raise KeyboardInterrupt
+
+    def close(self):
+        pass
+
+
+class ScriptedWatcher(IdleWatcher):
+    """
+    Reports a delivery to INBOX, then an overflow making the daemon rescan
+    every mailbox, then interrupts it
+    """
+
+    def __init__(self, inbox: Maildir):
+        self.inbox = inbox
+        self.events = 0
+
+    def wait(self, timeout=None):
+        self.events += 1
+        if self.events == 1:
+            key = self.inbox.add(SAMPLE)
+            return False, {('main', 'INBOX'): [join('new', key)]}
+        if self.events == 2:
+            return True, {}
+        raise KeyboardInterrupt
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        os.mkdir(join(self.tmp.name, 'main'))
+        self.inbox = Maildir(join(self.tmp.name, 'main', 'INBOX'))
+        self.archives = Maildir(join(self.tmp.name, 'main', 'Archives'))
+        self.key = self.inbox.add(SAMPLE)
+        self.conf = parse(join(self.tmp.name, 'rc'), RULES % self.tmp.name)
+
+    def tearDown(self):
+        delivery.stop()
+        self.tmp.cleanup()
+
+    def run_daemon(self, **opts) -> str:
+        output = StringIO()
+        with patch('bureaucrate.runner.Watcher', IdleWatcher), \
+                redirect_stdout(output):
+            self.assertEqual(runner.run(self.conf, ['main'],
+                                        dict(opts, daemon=True)), 0)
+        return output.getvalue()
+
+    def test_dry_run(self):
+        output = self.run_daemon(dry_run=True)
+        self.assertIn('move_to Archives: INBOX/%s' % self.key, output)
+        self.assertEqual(list(self.inbox.keys()), [self.key])
+        self.assertEqual(self.inbox[self.key].get_flags(), '')
+        self.assertEqual(len(self.archives), 0)
+
+    def test_plan(self):
+        self.assertEqual(self.run_daemon(plan=True), '')
+        self.assertEqual(len(self.inbox), 0)
+        self.assertEqual(self.archives[self.key].get_flags(), 'S')
+
+    def test_delivered_then_rescanned(self):
+        self.inbox.remove(self.key)
+        out = join(self.tmp.name, 'forwarded')
+        conf = parse(join(self.tmp.name, 'rc'),
+                     FORWARD % (self.tmp.name, out))
+        watcher = ScriptedWatcher(self.inbox)
+        with patch('bureaucrate.runner.Watcher', lambda: watcher):
+            self.assertEqual(runner.run(conf, ['main'], {'daemon': True}),
+                             0)
+        self.assertEqual(watcher.events, 3)
+        with open(out) as f:
+            self.assertEqual(f.read().count('Subject: Fwd: Hi there!'), 1)
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        os.mkdir(join(self.tmp.name, 'main'))
+        self.inbox = Maildir(join(self.tmp.name, 'main', 'INBOX'))
+        self.lists = Maildir(join(self.tmp.name, 'main', 'Lists'))
+        self.key = self.inbox.add(SAMPLE)
+        self.conf = parse(join(self.tmp.name, 'rc'),
+                          PARALLEL % self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_same_as_serial(self):
+        opts = {'jobs': 2, 'loglevel': logging.WARNING}
+        with self.assertLogs('bureaucrate', logging.INFO) as logs:
+            ok = runner.process_parallel(self.conf, ['main', 'gone'], 2,
+                                         opts)
+        self.assertFalse(ok)
+        messages = [r.getMessage() for r in logs.records]
+        self.assertIn('main/INBOX: 1 messages processed', messages)
+        self.assertIn('main/Lists: 1 messages processed', messages)
+        # replayed from the worker
+        self.assertTrue(any(m.startswith('failed to process gone')
+                            for m in messages))
+        self.assertEqual(len(self.inbox), 0)
+        self.assertEqual(len(self.lists), 0)
+        self.assertEqual(list(Maildir(join(self.tmp.name, 'main', 'Done'))
+                              .keys()), [self.key])
+
+
+if __name__ == '__main__':
+    unittest.main()
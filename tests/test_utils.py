@@ -1,6 +1,23 @@
+import os
 import unittest
-from bureaucrate.utils import parse_timespec
+from bureaucrate.utils import Config, parse_timespec
 from datetime import timedelta
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+CONFIG = """base_path = /tmp
+prefetch = 2
+main {
+    incremental = yes
+    INBOX {
+        prefetch = 4
+        if subject_has 'Hi' then star
+    }
+    Lists {
+    }
+}
+"""
 
 
 class TestUtils(unittest.TestCase):
@@ -11,5 +28,43 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(parse_timespec('1M 6d 10m 30s'), d)
 
 
+class TestConfigCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.path = join(self.tmp.name, 'rc')
+        self.cache = join(self.tmp.name, 'cache', 'rc.json')
+        with open(self.path, 'w') as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def parse(self) -> Config:
+        conf = Config()
+        conf.parse(self.path, self.cache)
+        return conf
+
+    def test_cached(self):
+        parsed = self.parse()
+        with patch.object(Config, 'parse_line') as parse_line:
+            cached = self.parse()
+            # same contents, another mtime
+            os.utime(self.path, (0, 0))
+            self.parse()
+        parse_line.assert_not_called()
+        self.assertEqual(cached.config, parsed.config)
+        self.assertEqual(cached.get_mailboxes('main'), ['INBOX', 'Lists'])
+        self.assertEqual(cached.get('prefetch', 0, 'INBOX', 'main'), '4')
+        self.assertEqual(cached.get('prefetch', 0, 'Lists', 'main'), '2')
+        self.assertEqual(cached.get('incremental', account='main'), 'yes')
+        self.assertIsNone(cached.get('incremental'))
+
+    def test_changed(self):
+        self.parse()
+        with open(self.path, 'a') as f:
+            f.write('charsets = latin-1\n')
+        self.assertEqual(self.parse().get('charsets'), 'latin-1')
+
+
 if __name__ == '__main__':
     unittest.main()